@@ -0,0 +1,203 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks the game logic on each scenario, optionally comparing the results
+with an earlier run to catch slowdowns"""
+
+import gc
+import json
+import optparse
+import sys
+import timeit
+
+import gamelogic
+import scenarios
+import simulate
+import sweep
+
+RESULTS_VERSION = 1
+
+def measure(name, frames, seed, repeat):
+    """Runs a scenario repeat times and returns the figures from the fastest run.
+
+    allocs_per_frame is the net number of garbage-collected objects created per
+    frame, which counts anything a frame leaves behind, including cycles."""
+    timer = timeit.default_timer
+    best = None
+
+    for i in range(repeat):
+        state = scenarios.build(name, seed)
+        inputs = simulate.random_inputs(seed)
+        frame_times = []
+        allocs = 0
+        objects = 0
+
+        gc.collect()
+        gc.disable()
+        try:
+            for frame in xrange(frames):
+                frame_inputs = next(inputs)
+                count = gc.get_count()[0]
+                start = timer()
+                state.advance(frame_inputs)
+                frame_times.append(timer() - start)
+                allocs += gc.get_count()[0] - count
+                objects += len(state.objects)
+                if gc.get_count()[0] > 100000:
+                    gc.enable()
+                    gc.collect()
+                    gc.disable()
+        finally:
+            gc.enable()
+
+        frame_times.sort()
+        result = {
+            'frames': frames,
+            'mean_ms': sum(frame_times) * 1000 / frames,
+            'p50_ms': simulate.percentile(frame_times, 0.5) * 1000,
+            'p99_ms': simulate.percentile(frame_times, 0.99) * 1000,
+            'allocs_per_frame': allocs / float(frames),
+            'mean_objects': objects / float(frames),
+            }
+        if best is None or result['mean_ms'] < best['mean_ms']:
+            best = result
+
+    return best
+
+def entity_size(obj):
+    """Returns the bytes taken by obj and its attribute dictionary, if it has
+    one, not counting the attribute values themselves"""
+    size = sys.getsizeof(obj)
+    try:
+        size += sys.getsizeof(obj.__dict__)
+    except AttributeError:
+        pass
+    return size
+
+def sample_entities():
+    "Returns (name, object) for one object of each kind a game is made of"
+    plunger = gamelogic.Plunger(0, 0, 16, 16)
+    return [
+        ('Robot', gamelogic.Robot(0, 0, 16, 16, 2)),
+        ('Ball', gamelogic.Ball(0, 0, 8, 8)),
+        ('Plunger', plunger),
+        ('DaggerBit', gamelogic.DaggerBit(plunger, 3, 3, 8)),
+        ('ForegroundWall', gamelogic.ForegroundWall(0, 0, 16, 16)),
+        ]
+
+def measure_memory(frames, seed):
+    """Returns the size of each kind of object, and how many Robots the default
+    scenario created and had to construct while played by the hunting AI for
+    up to frames frames"""
+    sizes = dict((name, entity_size(obj)) for name, obj in sample_entities())
+
+    state = scenarios.build('default', seed)
+    for frame in xrange(frames):
+        if not state.count(gamelogic.Plunger):
+            break
+        state.advance(sweep.hunt(state))
+
+    constructed = state.constructed.get(gamelogic.Robot, 0)
+    return {'entity_bytes': sizes,
+            'frames_played': frame + 1,
+            'robots_created': constructed + state.reused.get(gamelogic.Robot, 0),
+            'robots_constructed': constructed}
+
+def compare(results, baseline, threshold):
+    """Returns (name, old, new) for each scenario whose mean frame time grew by
+    more than threshold, a fraction of the old time"""
+    regressions = []
+    for name, result in sorted(results['scenarios'].items()):
+        try:
+            old = baseline['scenarios'][name]
+        except KeyError:
+            continue
+        if result['mean_ms'] > old['mean_ms'] * (1 + threshold):
+            regressions.append((name, old, result))
+    return regressions
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [scenario...]")
+    parser.add_option('-n', '--frames', type='int', default=1000,
+        help="number of frames to simulate per run")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help="number of runs per scenario; the fastest is kept")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', metavar='FILE',
+        help="write results to FILE as JSON")
+    parser.add_option('-c', '--compare', metavar='FILE',
+        help="compare with results saved in FILE, failing on slowdowns")
+    parser.add_option('-t', '--threshold', type='float', default=10.0,
+        help="percent slowdown in mean frame time that counts as a regression")
+    parser.add_option('-m', '--memory', action='store_true',
+        help="also report the memory taken by each kind of object")
+    options, args = parser.parse_args(argv)
+
+    names = args or sorted(scenarios.scenarios)
+    for name in names:
+        if name not in scenarios.scenarios:
+            parser.error("unknown scenario %s" % name)
+
+    results = {'version': RESULTS_VERSION, 'seed': options.seed, 'scenarios': {}}
+    for name in names:
+        result = measure(name, options.frames, options.seed, options.repeat)
+        results['scenarios'][name] = result
+        print "%-10s mean %.3fms  p50 %.3fms  p99 %.3fms  %.1f allocs/frame  %.1f objects" % (
+            name, result['mean_ms'], result['p50_ms'], result['p99_ms'],
+            result['allocs_per_frame'], result['mean_objects'])
+
+    if options.memory:
+        memory = results['memory'] = measure_memory(options.frames, options.seed)
+        for name, size in sorted(memory['entity_bytes'].items()):
+            print "%-14s %4d bytes" % (name, size)
+        print "robots in %d frames of default, hunting: %d created, %d constructed" % (
+            memory['frames_played'], memory['robots_created'], memory['robots_constructed'])
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline.get('version') != RESULTS_VERSION:
+            print "%s: results version %s, expected %s" % (options.compare, baseline.get('version'), RESULTS_VERSION)
+            return 2
+
+        regressions = compare(results, baseline, options.threshold / 100)
+        for name, old, new in regressions:
+            print "REGRESSION %s: mean %.3fms -> %.3fms (+%.1f%%)" % (
+                name, old['mean_ms'], new['mean_ms'], (new['mean_ms'] / old['mean_ms'] - 1) * 100)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
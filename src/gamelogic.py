@@ -21,8 +21,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import collections
+import copy
 import math
+import operator
 import random
+import timeit
 
 UP = "UP"
 LEFT = "LEFT"
@@ -36,26 +40,176 @@ direction_angles = {
     DOWN: math.pi * 1.5,
     }
 
+# returned by collide(): ABORT stops the move, BLOCK stops only this step
 ABORT = "ABORT"
 BLOCK = "BLOCK"
+
+# requests returned by advance(), see Commands
 DELETE = "DELETE"
 ADD = "ADD"
 
+slot_name_cache = {}
+
+def slot_names(cls):
+    "Returns the names of the attributes kept in __slots__ by cls and its bases"
+    try:
+        return slot_name_cache[cls]
+    except KeyError:
+        pass
+    names = []
+    for base in cls.__mro__:
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        names.extend(name for name in slots if name not in ('__dict__', '__weakref__'))
+    result = slot_name_cache[cls] = tuple(names)
+    return result
+
+class Unset(object):
+    "Stands in the results of get_attributes() for a slot with no value"
+
+slot_getter_cache = {}
+
+def slot_getter(cls):
+    """Returns a function giving a tuple of the values of the slot_names() of
+    an instance of cls"""
+    try:
+        return slot_getter_cache[cls]
+    except KeyError:
+        pass
+    names = slot_names(cls)
+    if len(names) > 1:
+        result = operator.attrgetter(*names)
+    elif names:
+        get = operator.attrgetter(names[0])
+        result = lambda obj: (get(obj),)
+    else:
+        result = lambda obj: ()
+    slot_getter_cache[cls] = result
+    return result
+
+def get_attributes(obj):
+    """Returns a tuple of obj's attributes: the values of its __slots__ in the
+    order of slot_names(), then a copy of its __dict__ if it has one. The
+    values are shared, not copied."""
+    cls = type(obj)
+    try:
+        result = slot_getter(cls)(obj)
+    except AttributeError:
+        result = tuple(getattr(obj, name, Unset) for name in slot_names(cls))
+    if cls.__dictoffset__:
+        result += (obj.__dict__.copy(),)
+    return result
+
+def set_attributes(obj, attributes):
+    """Replaces all of obj's attributes with those from get_attributes(), or
+    removes them all if attributes is None"""
+    cls = type(obj)
+    names = slot_names(cls)
+    if attributes is None:
+        for name in names:
+            if hasattr(obj, name):
+                delattr(obj, name)
+        if cls.__dictoffset__:
+            obj.__dict__.clear()
+        return
+    for name, value in zip(names, attributes):
+        if value is not Unset:
+            setattr(obj, name, value)
+        elif hasattr(obj, name):
+            delattr(obj, name)
+    if cls.__dictoffset__:
+        d = obj.__dict__
+        d.clear()
+        d.update(attributes[-1])
+
+class CollisionTable(dict):
+    "Maps (type, other type) to find(type, other type), calling it once for each key"
+
+    def __init__(self, find):
+        dict.__init__(self)
+        self.find = find
+
+    def __missing__(self, key):
+        result = self[key] = self.find(*key)
+        return result
+
+def find_collision_handler(objtype, othtype):
+    for cls in objtype.__mro__:
+        if cls is not Moveable and 'collide' in cls.__dict__:
+            # a class that overrides collide() handles every contact itself
+            return cls.__dict__['collide']
+        for oth_cls in othtype.__mro__:
+            entry = collision_handlers.get((cls, oth_cls))
+            if entry is not None:
+                handler, when = entry
+                if when is None or when(othtype):
+                    return handler
+    return None
+
+def find_collision_pair(objtype, othtype):
+    handler = collision_handlers_by_type[objtype, othtype]
+    reverse = collision_handlers_by_type[othtype, objtype]
+    if handler is None and reverse is None:
+        return None
+    return (handler, reverse)
+
+# (class, other class) -> (handler, when), from add_collision()
+collision_handlers = {}
+
+# (type, other type) -> the handler for them, or None if nothing happens
+collision_handlers_by_type = CollisionTable(find_collision_handler)
+
+# (type, other type) -> (handler, reverse handler) for the first moving into the
+# second, or None if neither does anything
+collision_pairs = CollisionTable(find_collision_pair)
+
+def add_collision(cls, oth_cls, handler, when=None):
+    """Registers handler(obj, oth, direction, state, dx, dy) to be called when an
+    instance of cls touches an instance of oth_cls, returning what collide()
+    would. If when is given, the handler is only used if when(type(oth)) is true.
+
+    The handler for a pair of types is found once, trying the registered pairs
+    of classes in method resolution order, those of obj first, so anything the
+    handlers don't check themselves must be a class attribute."""
+    collision_handlers[cls, oth_cls] = (handler, when)
+    collision_handlers_by_type.clear()
+    collision_pairs.clear()
+
+def is_solid(cls):
+    return cls.solid
+
 class Inputs(object):
     dx = 0
     dy = 0
     buttons_pressed = ()
 
 class GameObject(object):
+    # no __dict__ here, so that subclasses can keep all their attributes in
+    # __slots__; those that don't declare __slots__ get a __dict__ as usual
+    __slots__ = ()
+
     physical = False    # True if this object has a location in space
     dead = False        # True if this object should be removed before the next frame
     solid = False       # True if this object gets in the way of moving objects
     player_weapon = 0   # Non-zero weapon power if this is dangerous to enemies
     sprite = None       # Not used by this module, may be a pixmap to draw this
+    static = False      # True if advance() never does anything, so it needn't be called
+    sleeping = False    # True if advance() is skipped until State.wake() is called
+    wake_on = None      # class whose instances wake this object when added, while sleeping
+    pooled = False      # True if dead instances may be reused by State.create(); nothing
+                        # may keep a reference to one after it dies
 
     def kill(self):
         self.dead = True
 
+    def copy(self):
+        "Returns a new object with the same attributes"
+        return copy.copy(self)
+
+    def advance(self, state, inputs):
+        return ()
+
 class ScreenEdge(GameObject):
     solid = True
 
@@ -76,10 +230,25 @@ class Ground(Tile):
 class Wall(Tile):
     solid = True
 
+# passed to collide() for the solid tiles in State.solid
+WALL_TILE = Wall()
+
+def step_index(d, steps, k):
+    "Returns the step of move() at which the k'th pixel of a d pixel movement is taken"
+    if d > 0:
+        return -(-k * steps // d)
+    else:
+        return (k - 1) * steps // -d + 1
+
 class Moveable(GameObject):
+    # slots hide the class defaults of GameObject, so __init__ sets them all;
+    # subclasses add slots for their own attributes
+    __slots__ = ('x', 'y', 'width', 'height', 'xerror', 'yerror', 'dead', 'sleeping', 'wake_on')
+
     physical = True
-    xerror = 0.0
-    yerror = 0.0
+    swept = False       # True to find contacts with sweep() instead of testing every pixel
+    sweep_steps = 8     # ...for moves of more than this many steps; shorter ones are
+                        # cheaper pixel by pixel
 
     def __init__(self, x, y, width, height):
         self.x = x
@@ -88,87 +257,213 @@ class Moveable(GameObject):
         self.width = width
         self.height = height
 
+        self.xerror = 0.0
+        self.yerror = 0.0
+        self.dead = False
+        self.sleeping = False
+        self.wake_on = None
+
+    def collide_tiles(self, state, left, top, right, bottom, direction, dx, dy):
+        """Calls collide() for each solid tile under the pixels from (left, top)
+        to (right, bottom), stopping at the first that returns something"""
+        handler = collision_handlers_by_type[type(self), Wall]
+        if handler is None:
+            return
+        tw = state.tilewidth
+        th = state.tileheight
+        solid = state.solid
+        xtiles = state.xtiles
+        for ty in range(max(top // th, 0), min(bottom // th, state.ytiles - 1) + 1):
+            row = ty * xtiles
+            for tx in range(max(left // tw, 0), min(right // tw, xtiles - 1) + 1):
+                if solid[row + tx]:
+                    if state.stats is not None:
+                        state.stats.collisions[direction] += 1
+                    ret = handler(self, WALL_TILE, direction, state, dx, dy)
+                    if ret:
+                        return ret
+
     def move_left(self, state, dx, dy):
         newx = self.x - 1
+        stats = state.stats
 
         if newx < 0:
+            if stats is not None:
+                stats.collisions[LEFT] += 1
             ret = self.collide(LEFT_EDGE, LEFT, state, dx, dy)
             if ret:
                 return ret
 
-        for obj in state.objects:
+        if state.solid:
+            ret = self.collide_tiles(state, newx, self.y, newx, self.y + self.height - 1, LEFT, dx, dy)
+            if ret:
+                return ret
+
+        candidates = state.grid.query(newx, self.y, newx, self.y + self.height - 1)
+        if stats is not None:
+            stats.candidates += len(candidates)
+
+        for obj in candidates:
             if obj is not self and \
-               isinstance(obj, Moveable) and \
                obj.x <= newx < obj.x + obj.width and \
                max(self.y, obj.y) < min(self.y + self.height, obj.y + obj.height):
-                ret = self.collide(obj, LEFT, state, dx, dy)
-                obj.collide(self, RIGHT, state, 0, 0)
+                pair = collision_pairs[type(self), type(obj)]
+                if pair is None:
+                    # neither reacts to the other, so they pass through
+                    continue
+                handler, reverse = pair
+                if stats is not None:
+                    stats.collisions[LEFT] += 1
+                    stats.collisions[RIGHT] += 1
+                ret = None
+                if handler is not None:
+                    ret = handler(self, obj, LEFT, state, dx, dy)
+                if reverse is not None:
+                    reverse(obj, self, RIGHT, state, 0, 0)
+                if obj.sleeping:
+                    state.wake(obj)
                 if ret:
                     return ret
 
         self.x = newx
+        state.grid.update(self)
 
     def move_right(self, state, dx, dy):
         newx = self.x + 1
         newedge = newx + self.width
+        stats = state.stats
 
         if newedge >= state.width:
+            if stats is not None:
+                stats.collisions[RIGHT] += 1
             ret = self.collide(RIGHT_EDGE, RIGHT, state, dx, dy)
             if ret:
                 return ret
 
-        for obj in state.objects:
+        if state.solid:
+            ret = self.collide_tiles(state, newedge, self.y, newedge, self.y + self.height - 1, RIGHT, dx, dy)
+            if ret:
+                return ret
+
+        candidates = state.grid.query(newedge, self.y, newedge, self.y + self.height - 1)
+        if stats is not None:
+            stats.candidates += len(candidates)
+
+        for obj in candidates:
             if obj is not self and \
-               isinstance(obj, Moveable) and \
                obj.x <= newedge < obj.x + obj.width and \
                max(self.y, obj.y) < min(self.y + self.height, obj.y + obj.height):
-                ret = self.collide(obj, RIGHT, state, dx, dy)
-                obj.collide(self, LEFT, state, 0, 0)
+                pair = collision_pairs[type(self), type(obj)]
+                if pair is None:
+                    # neither reacts to the other, so they pass through
+                    continue
+                handler, reverse = pair
+                if stats is not None:
+                    stats.collisions[RIGHT] += 1
+                    stats.collisions[LEFT] += 1
+                ret = None
+                if handler is not None:
+                    ret = handler(self, obj, RIGHT, state, dx, dy)
+                if reverse is not None:
+                    reverse(obj, self, LEFT, state, 0, 0)
+                if obj.sleeping:
+                    state.wake(obj)
                 if ret:
                     return ret
 
         self.x = newx
+        state.grid.update(self)
 
     def move_up(self, state, dx, dy):
         newy = self.y - 1
+        stats = state.stats
 
         if newy < 0:
+            if stats is not None:
+                stats.collisions[UP] += 1
             ret = self.collide(TOP_EDGE, UP, state, dx, dy)
             if ret:
                 return ret
 
-        for obj in state.objects:
+        if state.solid:
+            ret = self.collide_tiles(state, self.x, newy, self.x + self.width - 1, newy, UP, dx, dy)
+            if ret:
+                return ret
+
+        candidates = state.grid.query(self.x, newy, self.x + self.width - 1, newy)
+        if stats is not None:
+            stats.candidates += len(candidates)
+
+        for obj in candidates:
             if obj is not self and \
-               isinstance(obj, Moveable) and \
                obj.y <= newy < obj.y + obj.height and \
                max(self.x, obj.x) < min(self.x + self.width, obj.x + obj.width):
-                ret = self.collide(obj, UP, state, dx, dy)
-                obj.collide(self, DOWN, state, 0, 0)
+                pair = collision_pairs[type(self), type(obj)]
+                if pair is None:
+                    # neither reacts to the other, so they pass through
+                    continue
+                handler, reverse = pair
+                if stats is not None:
+                    stats.collisions[UP] += 1
+                    stats.collisions[DOWN] += 1
+                ret = None
+                if handler is not None:
+                    ret = handler(self, obj, UP, state, dx, dy)
+                if reverse is not None:
+                    reverse(obj, self, DOWN, state, 0, 0)
+                if obj.sleeping:
+                    state.wake(obj)
                 if ret:
                     return ret
 
         self.y = newy
+        state.grid.update(self)
 
     def move_down(self, state, dx, dy):
         newy = self.y + 1
         newedge = newy + self.height
+        stats = state.stats
 
         if newedge >= state.height:
+            if stats is not None:
+                stats.collisions[DOWN] += 1
             ret = self.collide(BOTTOM_EDGE, DOWN, state, dx, dy)
             if ret:
                 return ret
 
-        for obj in state.objects:
+        if state.solid:
+            ret = self.collide_tiles(state, self.x, newedge, self.x + self.width - 1, newedge, DOWN, dx, dy)
+            if ret:
+                return ret
+
+        candidates = state.grid.query(self.x, newedge, self.x + self.width - 1, newedge)
+        if stats is not None:
+            stats.candidates += len(candidates)
+
+        for obj in candidates:
             if obj is not self and \
-               isinstance(obj, Moveable) and \
                obj.y <= newedge < obj.y + obj.height and \
                max(self.x, obj.x) < min(self.x + self.width, obj.x + obj.width):
-                ret = self.collide(obj, DOWN, state, dx, dy)
-                obj.collide(self, UP, state, 0, 0)
+                pair = collision_pairs[type(self), type(obj)]
+                if pair is None:
+                    # neither reacts to the other, so they pass through
+                    continue
+                handler, reverse = pair
+                if stats is not None:
+                    stats.collisions[DOWN] += 1
+                    stats.collisions[UP] += 1
+                ret = None
+                if handler is not None:
+                    ret = handler(self, obj, DOWN, state, dx, dy)
+                if reverse is not None:
+                    reverse(obj, self, UP, state, 0, 0)
+                if obj.sleeping:
+                    state.wake(obj)
                 if ret:
                     return ret
 
         self.y = newy
+        state.grid.update(self)
 
     def move(self, state, dx, dy):
         if isinstance(dx, float):
@@ -182,6 +477,10 @@ class Moveable(GameObject):
 
         steps = max(abs(dx), abs(dy))
 
+        if self.swept and steps > self.sweep_steps:
+            self.sweep(state, dx, dy)
+            return
+
         x = y = 0
 
         for i in range(1, steps+1):
@@ -205,6 +504,129 @@ class Moveable(GameObject):
                     return
             y = newy
 
+    def sweep(self, state, dx, dy):
+        """Moves along the same path as the pixel stepping in move(), finding the
+        first step that touches something from the bounding boxes involved and
+        only running a collision pass for that step.
+
+        Steps are numbered as ticks: tick 2*i is the x movement of step i, and
+        tick 2*i+1 is the y movement."""
+        steps = max(abs(dx), abs(dy))
+        xsign = cmp(dx, 0)
+        ysign = cmp(dy, 0)
+        xtotal = abs(dx)
+        ytotal = abs(dy)
+        width = self.width
+        height = self.height
+
+        tick = 2
+        while True:
+            ax = self.x
+            ay = self.y
+            # pixels already moved on each axis before this tick
+            xdone = abs(dx * ((tick - 1) // 2) // steps)
+            ydone = abs(dy * ((tick - 2) // 2) // steps)
+            xleft = xtotal - xdone
+            yleft = ytotal - ydone
+
+            endx = ax + xsign * xleft
+            endy = ay + ysign * yleft
+
+            first = steps * 2 + 2
+
+            # screen edges
+            if xsign < 0:
+                m = max(1, ax + 1)
+            else:
+                m = max(1, state.width - width - ax)
+            if xleft and m <= xleft:
+                first = min(first, 2 * step_index(dx, steps, xdone + m))
+
+            if ysign < 0:
+                m = max(1, ay + 1)
+            else:
+                m = max(1, state.height - height - ay)
+            if yleft and m <= yleft:
+                first = min(first, 2 * step_index(dy, steps, ydone + m) + 1)
+
+            left = min(ax, endx)
+            top = min(ay, endy)
+            right = max(ax, endx) + width
+            bottom = max(ay, endy) + height
+
+            candidates = state.grid.query(left, top, right, bottom)
+            if state.stats is not None:
+                state.stats.candidates += len(candidates)
+
+            boxes = [(obj.x, obj.y, obj.width, obj.height) for obj in candidates if obj is not self]
+            if state.solid:
+                boxes.extend(state.solid_boxes(left, top, right, bottom))
+
+            for ox, oy, ow, oh in boxes:
+
+                if xleft:
+                    if xsign < 0:
+                        lo = ax - ox - ow + 1
+                        hi = ax - ox
+                    else:
+                        lo = ox - ax - width
+                        hi = ox + ow - 1 - ax - width
+                    for m in range(max(1, lo), min(hi, xleft) + 1):
+                        t = 2 * step_index(dx, steps, xdone + m)
+                        if t >= first:
+                            break
+                        y = ay + ysign * (abs(dy * (t // 2 - 1) // steps) - ydone)
+                        if max(y, oy) < min(y + height, oy + oh):
+                            first = t
+                            break
+
+                if yleft:
+                    if ysign < 0:
+                        lo = ay - oy - oh + 1
+                        hi = ay - oy
+                    else:
+                        lo = oy - ay - height
+                        hi = oy + oh - 1 - ay - height
+                    for m in range(max(1, lo), min(hi, yleft) + 1):
+                        t = 2 * step_index(dy, steps, ydone + m) + 1
+                        if t >= first:
+                            break
+                        x = ax + xsign * (abs(dx * (t // 2) // steps) - xdone)
+                        if max(x, ox) < min(x + width, ox + ow):
+                            first = t
+                            break
+
+            if first > steps * 2 + 1:
+                self.x = endx
+                self.y = endy
+                state.grid.update(self)
+                return
+
+            # skip ahead to the contact, then take that step as move() would
+            i = first // 2
+            x = dx * (i - 1) // steps
+            y = dy * (i - 1) // steps
+            if first % 2:
+                x = dx * i // steps
+            self.x = ax + xsign * (abs(x) - xdone)
+            self.y = ay + ysign * (abs(y) - ydone)
+            state.grid.update(self)
+
+            if first % 2 == 0:
+                if xsign < 0:
+                    ret = self.move_left(state, dx-x, dy-y)
+                else:
+                    ret = self.move_right(state, dx-x, dy-y)
+            else:
+                if ysign < 0:
+                    ret = self.move_up(state, dx-x, dy-y)
+                else:
+                    ret = self.move_down(state, dx-x, dy-y)
+            if ret == ABORT:
+                return
+
+            tick = first + 1
+
     def moveto(self, state, x, y):
         return self.move(state, x-self.x, y-self.y)
 
@@ -226,11 +648,18 @@ class Moveable(GameObject):
         return dx, dy
 
     def collide(self, oth, direction, state, dx, dy):
-        pass
+        """Called when this touches oth, returning ABORT to stop moving or BLOCK
+        to skip this step, using the handler registered with add_collision()"""
+        handler = collision_handlers_by_type[type(self), type(oth)]
+        if handler is not None:
+            return handler(self, oth, direction, state, dx, dy)
 
 class ForegroundWall(Moveable):
+    __slots__ = ()
+
     physical = True
     solid = True
+    static = True
 
 def angle_to_offset(dx, dy):
         try:
@@ -245,9 +674,10 @@ def angle_to_offset(dx, dy):
                 return math.pi * 0.5
 
 class Turnable(Moveable):
+    __slots__ = ('angle',)
 
-    def __init__(self, *args):
-        Moveable.__init__(self, *args)
+    def __init__(self, x, y, width, height):
+        Moveable.__init__(self, x, y, width, height)
         self.angle = 0.0
 
     def turn_to_offset(self, dx, dy):
@@ -270,6 +700,8 @@ class Turnable(Moveable):
         self.turn_to_offset(dx, dy)
 
 class Ball(Turnable):
+    __slots__ = ('speed',)
+
     player_weapon = 1
 
     def __init__(self, x=0, y=0, width=8, height=8, angle=math.atan(2), speed=4):
@@ -277,44 +709,52 @@ class Ball(Turnable):
         self.speed = speed
         self.angle = angle
 
-    def copy(self):
-        return Ball(self.x, self.y, self.width, self.height, self.dx, self.dy, self.speed)
+    def straight_line(self, inputs):
+        """Returns True if advance() will only do what Ball.advance does, so that
+        a projectiles.Batch can move this ball instead"""
+        return True
 
     def advance(self, state, inputs):
         self.move(state, self.speed * math.cos(self.angle), self.speed * math.sin(self.angle))
 
         return ()
 
-    def collide(self, oth, direction, state, dx, dy):
-        if oth.solid:
-            if (direction == LEFT and math.cos(self.angle) < 0) or\
-               (direction == RIGHT and math.cos(self.angle) > 0):
-                self.angle = math.pi - self.angle
-            elif (direction == UP and math.sin(self.angle) < 0) or\
-                 (direction == DOWN and math.sin(self.angle) > 0):
-                self.angle = math.pi*2 - self.angle
-            return ABORT
+def ball_bounces(ball, oth, direction, state, dx, dy):
+    if (direction == LEFT and math.cos(ball.angle) < 0) or\
+       (direction == RIGHT and math.cos(ball.angle) > 0):
+        ball.angle = math.pi - ball.angle
+    elif (direction == UP and math.sin(ball.angle) < 0) or\
+         (direction == DOWN and math.sin(ball.angle) > 0):
+        ball.angle = math.pi*2 - ball.angle
+    return ABORT
+
+add_collision(Ball, GameObject, ball_bounces, is_solid)
 
 class FairyBall(Ball):
+    __slots__ = ()
+
+    def straight_line(self, inputs):
+        return 1 not in inputs.buttons_pressed
+
     def advance(self, state, inputs):
         if 1 in inputs.buttons_pressed:
-            for oth in state.objects:
-                if isinstance(oth, Plunger):
-                    self.x = (oth.x + oth.width/2) - self.width / 2
-                    self.y = (oth.y + oth.height/2) - self.height / 2
-                    return ()
+            for oth in state.instances(Plunger):
+                self.x = (oth.x + oth.width/2) - self.width / 2
+                self.y = (oth.y + oth.height/2) - self.height / 2
+                return ()
 
         return Ball.advance(self, state, inputs)
 
-    def collide(self, oth, direction, state, dx, dy):
-        if isinstance(oth, Plunger):
-            self.angle = oth.angle
-        else:
-            Ball.collide(self, oth, direction, state, dx, dy)
-
 class Boomerang(Ball):
-    caught = None
-    uncaught = None
+    __slots__ = ('caught', 'uncaught')
+
+    def __init__(self, x=0, y=0, width=8, height=8, angle=math.atan(2), speed=4):
+        Ball.__init__(self, x, y, width, height, angle, speed)
+        self.caught = None
+        self.uncaught = None
+
+    def straight_line(self, inputs):
+        return not self.caught and not self.uncaught
 
     def advance(self, state, inputs):
         if self.caught:
@@ -333,32 +773,27 @@ class Boomerang(Ball):
 
         return Ball.advance(self, state, inputs)
 
-    def collide(self, oth, direction, state, dx, dy):
-        if isinstance(oth, Plunger):
-            self.angle = oth.angle
-            if oth is not self.uncaught:
-                self.caught = oth
-        elif oth.solid:
-            if (direction == LEFT and math.cos(self.angle) < 0) or\
-               (direction == RIGHT and math.cos(self.angle) > 0) or \
-               (direction == UP and math.sin(self.angle) < 0) or \
-               (direction == DOWN and math.sin(self.angle) > 0):
-                self.angle = self.angle + math.pi
-            return ABORT
+def boomerang_returns(boomerang, oth, direction, state, dx, dy):
+    if (direction == LEFT and math.cos(boomerang.angle) < 0) or\
+       (direction == RIGHT and math.cos(boomerang.angle) > 0) or \
+       (direction == UP and math.sin(boomerang.angle) < 0) or \
+       (direction == DOWN and math.sin(boomerang.angle) > 0):
+        boomerang.angle = boomerang.angle + math.pi
+    return ABORT
+
+add_collision(Boomerang, GameObject, boomerang_returns, is_solid)
 
 class Plunger(Turnable):
     "Plunger will follow the mouse"
+    __slots__ = ()
+
     solid = True
-    angle = 0.0
     turn_radius = 12.0
 
     def __init__(self, x, y, width, height, direction=UP):
         Moveable.__init__(self, x, y, width, height)
         self.angle = direction_angles[direction]
 
-    def copy(self):
-        return Plunger(self.x, self.y, self.width, self.height, direction)
-
     def advance(self, state, inputs):
         if 3 not in inputs.buttons_pressed:
             self.move(state, inputs.dx, inputs.dy)
@@ -368,11 +803,29 @@ class Plunger(Turnable):
 
         return ()
 
-    def collide(self, oth, direction, state, dx, dy):
-        if oth.solid:
-            return BLOCK
+def plunger_blocked(plunger, oth, direction, state, dx, dy):
+    return BLOCK
+
+def fairy_ball_bounces(ball, oth, direction, state, dx, dy):
+    # turns like a Ball, but keeps moving
+    ball_bounces(ball, oth, direction, state, dx, dy)
+
+def fairy_ball_aimed(ball, plunger, direction, state, dx, dy):
+    ball.angle = plunger.angle
+
+def boomerang_caught(boomerang, plunger, direction, state, dx, dy):
+    boomerang.angle = plunger.angle
+    if plunger is not boomerang.uncaught:
+        boomerang.caught = plunger
+
+add_collision(Plunger, GameObject, plunger_blocked, is_solid)
+add_collision(FairyBall, GameObject, fairy_ball_bounces, is_solid)
+add_collision(FairyBall, Plunger, fairy_ball_aimed)
+add_collision(Boomerang, Plunger, boomerang_caught)
 
 class DaggerBit(Moveable):
+    __slots__ = ('owner', 'distance')
+
     player_weapon = 1
 
     def __init__(self, owner, width, height, distance):
@@ -388,42 +841,55 @@ class DaggerBit(Moveable):
 
     def advance(self, state, inputs):
         x, y = self.ideal_position()
+        if self.owner.dead and (x, y) == (self.x, self.y):
+            # the owner won't move again, so neither will this
+            state.sleep(self)
+            return ()
         self.moveto(state, x, y)
         return ()
 
 class Robot(Moveable):
     "Robot will move towards the plunger"
+    __slots__ = ('speed', 'deadly')
+
     solid = True
+    pooled = True
 
     def __init__(self, x, y, width, height, speed, deadly=True):
         Moveable.__init__(self, x, y, width, height)
         self.speed = speed
         self.deadly = deadly
 
-    def copy(self):
-        return Robot(self.x, self.y, self.width, self.height, speed)
-
     def advance(self, state, inputs):
-        for obj in state.objects:
-            if isinstance(obj, Plunger):
-                dx = obj.x + obj.width / 2 - self.x - self.width / 2
-                dy = obj.y + obj.height / 2 - self.y - self.height / 2
-                if 0 == dy == dx:
-                    return ()
-                elif abs(dx) > abs(dy):
-                    self.move(state, min(self.speed, abs(dx)) * cmp(dx, 0), 0)
-                else:
-                    self.move(state, 0, min(self.speed, abs(dy)) * cmp(dy, 0))
+        if not state.count(Plunger):
+            state.sleep(self, Plunger)
+            return ()
+
+        for obj in state.instances(Plunger):
+            dx = obj.x + obj.width / 2 - self.x - self.width / 2
+            dy = obj.y + obj.height / 2 - self.y - self.height / 2
+            if 0 == dy == dx:
+                return ()
+            elif abs(dx) > abs(dy):
+                self.move(state, min(self.speed, abs(dx)) * cmp(dx, 0), 0)
+            else:
+                self.move(state, 0, min(self.speed, abs(dy)) * cmp(dy, 0))
 
         return ()
 
-    def collide(self, oth, direction, state, dx, dy):
-        if oth.player_weapon >= 1:
-            self.kill()
-        if self.deadly and isinstance(oth, Plunger):
-            oth.kill()
-        if oth.solid:
-            return ABORT
+def robot_hit(robot, oth, direction, state, dx, dy):
+    if oth.player_weapon >= 1:
+        robot.kill()
+    if oth.solid:
+        return ABORT
+
+def robot_catches_plunger(robot, plunger, direction, state, dx, dy):
+    if robot.deadly:
+        plunger.kill()
+    return robot_hit(robot, plunger, direction, state, dx, dy)
+
+add_collision(Robot, GameObject, robot_hit, lambda cls: cls.player_weapon >= 1 or cls.solid)
+add_collision(Robot, Plunger, robot_catches_plunger)
 
 class Generator(GameObject):
     "Spawns objects when there are fewer than N on the screen"
@@ -437,23 +903,22 @@ class Generator(GameObject):
         self.args = args
 
     def advance(self, state, inputs):
-        count = 0
-
-        for obj in state.objects:
-            if isinstance(obj, self.obj_type):
-                count += 1
-
-        if count < self.max_objects:
-            x = state.random.randint(0, state.width - self.width)
-            y = state.random.randint(0, state.height - self.height)
-
-            for obj in state.objects:
-                if isinstance(obj, Moveable) and \
-                    (((x + self.width/2) - (obj.x + obj.width/2))**2 +
-                     ((y + self.height/2) - (obj.y + obj.height/2))**2) < self.min_distance_sq:
+        if state.count(self.obj_type) < self.max_objects:
+            left, top, width, height = state.view()
+            x = left + state.random.randint(0, width - self.width)
+            y = top + state.random.randint(0, height - self.height)
+
+            # only objects with a center inside this square can be too close
+            cx = x + self.width/2
+            cy = y + self.height/2
+            r = int(math.sqrt(self.min_distance_sq)) + 1
+
+            for obj in state.grid.query(cx - r, cy - r, cx + r, cy + r):
+                if ((cx - (obj.x + obj.width/2))**2 +
+                    (cy - (obj.y + obj.height/2))**2) < self.min_distance_sq:
                     return ()
 
-            return ((ADD, self.obj_type(x, y, self.width, self.height, *self.args)),)
+            return ((ADD, state.create(self.obj_type, x, y, self.width, self.height, *self.args)),)
 
         return ()
 
@@ -474,8 +939,289 @@ class EscalatingGenerator(Generator):
 
         return Generator.advance(self, state, inputs)
 
+class SpatialHash(object):
+    """Uniform grid of cells, each listing the Moveables that overlap it.
+
+    Queries return objects in the order they were inserted, which is the same
+    order as State.objects, so collision handling is unaffected by the index."""
+
+    def __init__(self, cellwidth, cellheight):
+        self.cellwidth = cellwidth
+        self.cellheight = cellheight
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        self.next_order = 0
+
+    def cell_bounds(self, obj):
+        x = int(obj.x)
+        y = int(obj.y)
+        # empty objects still go in one cell so that distance queries find them
+        return (x // self.cellwidth, y // self.cellheight,
+                (x + max(obj.width, 1) - 1) // self.cellwidth,
+                (y + max(obj.height, 1) - 1) // self.cellheight)
+
+    def _link(self, obj, bounds):
+        cells = self.cells
+        left, top, right, bottom = bounds
+        for cy in range(top, bottom+1):
+            for cx in range(left, right+1):
+                try:
+                    cells[cx, cy].append(obj)
+                except KeyError:
+                    cells[cx, cy] = [obj]
+
+    def _unlink(self, obj, bounds):
+        cells = self.cells
+        left, top, right, bottom = bounds
+        for cy in range(top, bottom+1):
+            for cx in range(left, right+1):
+                bucket = cells[cx, cy]
+                bucket.remove(obj)
+                if not bucket:
+                    del cells[cx, cy]
+
+    def insert(self, obj):
+        bounds = self.cell_bounds(obj)
+        self.bounds[obj] = bounds
+        self.order[obj] = self.next_order
+        self.next_order += 1
+        self._link(obj, bounds)
+
+    def remove(self, obj):
+        bounds = self.bounds.pop(obj, None)
+        if bounds is not None:
+            del self.order[obj]
+            self._unlink(obj, bounds)
+
+    def insert_all(self, objs):
+        for obj in objs:
+            self.insert(obj)
+
+    def remove_all(self, objs):
+        "Removes objs, rebuilding each cell they were in once"
+        leaving = {}
+        for obj in objs:
+            bounds = self.bounds.pop(obj, None)
+            if bounds is None:
+                continue
+            del self.order[obj]
+            left, top, right, bottom = bounds
+            for cy in range(top, bottom+1):
+                for cx in range(left, right+1):
+                    try:
+                        leaving[cx, cy].add(obj)
+                    except KeyError:
+                        leaving[cx, cy] = set([obj])
+
+        cells = self.cells
+        for key, gone in leaving.iteritems():
+            bucket = [obj for obj in cells[key] if obj not in gone]
+            if bucket:
+                cells[key] = bucket
+            else:
+                del cells[key]
+
+    def update(self, obj):
+        "Move obj to the cells matching its current position, if it is indexed"
+        old_bounds = self.bounds.get(obj)
+        if old_bounds is None:
+            return
+        bounds = self.cell_bounds(obj)
+        if bounds != old_bounds:
+            self._unlink(obj, old_bounds)
+            self.bounds[obj] = bounds
+            self._link(obj, bounds)
+
+    def query(self, x0, y0, x1, y1):
+        "Returns objects that may overlap the pixels from (x0, y0) to (x1, y1) inclusive"
+        cells = self.cells
+        left = int(x0) // self.cellwidth
+        right = int(x1) // self.cellwidth
+        top = int(y0) // self.cellheight
+        bottom = int(y1) // self.cellheight
+
+        if left == right and top == bottom:
+            bucket = cells.get((left, top))
+            if not bucket:
+                return ()
+            elif len(bucket) == 1:
+                return tuple(bucket)
+            return sorted(bucket, key=self.order.__getitem__)
+
+        result = set()
+        for cy in range(top, bottom+1):
+            for cx in range(left, right+1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    result.update(bucket)
+        return sorted(result, key=self.order.__getitem__)
+
+class TypeIndex(object):
+    """Tracks the objects of each class, with subclasses counted as members of
+    their base classes, in the order they were inserted."""
+
+    def __init__(self):
+        self.members = {}
+        self.next_order = 0
+
+    def insert(self, obj):
+        order = self.next_order
+        self.next_order += 1
+        members = self.members
+        for cls in type(obj).__mro__:
+            try:
+                members[cls][obj] = order
+            except KeyError:
+                members[cls] = {obj: order}
+
+    def remove(self, obj):
+        members = self.members
+        for cls in type(obj).__mro__:
+            del members[cls][obj]
+
+    def insert_all(self, objs):
+        "Inserts objs in order, updating the members of each class once per type"
+        by_type = {}
+        order = self.next_order
+        for obj in objs:
+            try:
+                by_type[type(obj)][obj] = order
+            except KeyError:
+                by_type[type(obj)] = {obj: order}
+            order += 1
+        self.next_order = order
+
+        members = self.members
+        for objtype, group in by_type.iteritems():
+            for cls in objtype.__mro__:
+                try:
+                    members[cls].update(group)
+                except KeyError:
+                    members[cls] = dict(group)
+
+    def remove_all(self, objs):
+        by_type = {}
+        for obj in objs:
+            by_type.setdefault(type(obj), []).append(obj)
+
+        members = self.members
+        for objtype, group in by_type.iteritems():
+            for cls in objtype.__mro__:
+                cls_members = members[cls]
+                for obj in group:
+                    del cls_members[obj]
+
+    def count(self, cls):
+        return len(self.members.get(cls, ()))
+
+    def instances(self, cls):
+        objs = self.members.get(cls)
+        if not objs:
+            return ()
+        elif len(objs) == 1:
+            return objs.keys()
+        return sorted(objs, key=objs.__getitem__)
+
+class FrameStats(object):
+    "What happened during one call to State.advance"
+
+    def __init__(self):
+        self.time = 0.0
+        self.advance_time = {}  # class -> seconds spent in advance()
+        self.advance_count = {} # class -> number of advance() calls
+        self.candidates = 0     # objects checked for overlap while moving
+        self.collisions = {UP: 0, DOWN: 0, LEFT: 0, RIGHT: 0} # collide() calls by direction
+        self.added = {}         # class -> objects added
+        self.removed = {}       # class -> objects removed
+
+class Profile(object):
+    """Collects a FrameStats for each frame while set as State.profile, keeping
+    the most recent ones."""
+
+    def __init__(self, history=50):
+        self.frames = collections.deque(maxlen=history)
+
+    def summary(self):
+        "Returns a FrameStats with the averages over the recorded frames"
+        result = FrameStats()
+        if not self.frames:
+            return result
+        n = float(len(self.frames))
+
+        for frame in self.frames:
+            result.time += frame.time / n
+            result.candidates += frame.candidates / n
+            for direction, count in frame.collisions.iteritems():
+                result.collisions[direction] += count / n
+            for total, counts in ((result.advance_time, frame.advance_time),
+                                  (result.advance_count, frame.advance_count),
+                                  (result.added, frame.added),
+                                  (result.removed, frame.removed)):
+                for cls, count in counts.iteritems():
+                    total[cls] = total.get(cls, 0) + count / n
+
+        return result
+
+class Commands(object):
+    """The requests returned by advance() during one frame, which State carries
+    out together once every object has been advanced.
+
+    (ADD, obj) adds obj at the end of the frame, and (ADD, obj, frames) at the
+    end of the frame that many frames later. (DELETE, obj) kills obj and removes
+    it at the end of the frame. Other requests, like sounds, are returned by
+    State.advance."""
+
+    def __init__(self):
+        self.added = []
+        self.deferred = []      # (frames, obj)
+        self.deleted = []
+        self.other = []
+
+    def extend(self, requests):
+        for request in requests:
+            if isinstance(request, tuple):
+                if request[0] == ADD:
+                    if len(request) > 2 and request[2] > 0:
+                        self.deferred.append((request[2], request[1]))
+                    else:
+                        self.added.append(request[1])
+                    continue
+                elif request[0] == DELETE:
+                    self.deleted.append(request[1])
+                    continue
+            self.other.append(request)
+
+class Snapshot(object):
+    """The contents of a State at one frame, from State.snapshot().
+
+    Objects are saved by copying their attributes into tuples, which is cheap
+    because attribute values are shared rather than copied. Restoring puts the
+    saved attributes back into the same objects, so references between objects
+    still point where they did.
+
+    Static objects are saved as None: nothing changes them but kill(), so
+    restoring only needs to bring them back to life."""
+
+    def __init__(self, state):
+        self.objects = tuple(state.objects)
+        self.attributes = tuple(None if obj.static else get_attributes(obj) for obj in self.objects)
+        self.random_state = state.random.getstate()
+        self.frame = state.frame
+        self.deferred = dict((due, tuple(objs)) for (due, objs) in state.deferred.iteritems())
+        if state.world is not None:
+            self.world = state.world.snapshot()
+        else:
+            self.world = None
+
 class State(object):
-    "This object represents the state of the game at a frame."
+    """This object represents the state of the game at a frame.
+
+    Objects should be added with add() so that they are indexed.
+
+    Only the objects in awake are advanced each frame. Static objects never
+    are, and an object can leave itself out with sleep() until something
+    wakes it."""
 
     def __init__(self):
         self.tilewidth = 16
@@ -485,29 +1231,353 @@ class State(object):
         self.width = self.tilewidth * self.xtiles
         self.height = self.tileheight * self.ytiles
 
+        # one byte per tile, row by row, non-zero for walls
+        self.solid = bytearray()
+        self.tiles_version = 0
+
         self.objects = []
+        self.grid = SpatialHash(self.tilewidth, self.tileheight)
+        self.types = TypeIndex()
+        self.reset_schedule()
+
+        self.frame = 0          # number of frames advanced
+        self.deferred = {}      # frame -> objects to add at the end of it
+
+        self.constructed = {}   # class -> new objects made by create()
+        self.reused = {}        # class -> dead objects create() brought back
+
+        self.profile = None     # set to a Profile to collect statistics
+        self.stats = None       # FrameStats for the frame in progress, if profiling
+
+        # a world.World that picks which objects are in play, if the playing
+        # area is bigger than the screen
+        self.world = None
+
+        # the mapformat.Map the tiles came from, for drawing; not part of the
+        # game state
+        self.tilemap = None
+
+        # a projectiles.Batch that moves Balls in bulk, if set
+        self.projectiles = None
 
         self.random = random.Random()
         self.random.seed()
 
-    def advance(self, inputs):
-        """Returns the state at the next frame and any control requests (sounds,
-         quit, etc.)"""
-        to_add = []
+    def reset_schedule(self):
+        self.awake = []         # objects to advance, in the order of self.objects
+        self.woken = []         # objects woken since awake was last put in order
+        self.order = {}         # object -> number giving its place in self.objects
+        self.next_order = 0
+        self.waiting = {}       # class -> objects sleeping until an instance is added
+        self.free = {}          # class -> dead pooled objects that create() may reuse
+        self.dying = []         # pooled objects removed this frame, free from the next
+
+    def add(self, obj):
+        self.objects.append(obj)
+        self.types.insert(obj)
+        if isinstance(obj, Moveable):
+            self.grid.insert(obj)
+        self.schedule_added(obj)
+
+    def add_all(self, objs):
+        "Adds objs in order, as add() would, updating the indexes in bulk"
+        if not objs:
+            return
+        self.objects.extend(objs)
+        self.types.insert_all(objs)
+        self.grid.insert_all([obj for obj in objs if isinstance(obj, Moveable)])
+        for obj in objs:
+            self.schedule_added(obj)
+
+    def schedule_added(self, obj):
+        self.order[obj] = self.next_order
+        self.next_order += 1
+        if obj.sleeping:
+            if obj.wake_on is not None:
+                self.waiting.setdefault(obj.wake_on, []).append(obj)
+        elif not obj.static:
+            self.awake.append(obj)
+
+        if self.waiting:
+            for cls in type(obj).__mro__:
+                if cls in self.waiting:
+                    for waiter in self.waiting.pop(cls):
+                        if waiter.wake_on is cls:
+                            self.wake(waiter)
+
+    def create(self, cls, *args):
+        """Returns cls(*args), reusing a dead instance from an earlier frame if
+        cls is pooled and one is free"""
+        free = self.free.get(cls)
+        if free:
+            obj = free.pop()
+            set_attributes(obj, None)
+            obj.__init__(*args)
+            self.reused[cls] = self.reused.get(cls, 0) + 1
+            return obj
+        self.constructed[cls] = self.constructed.get(cls, 0) + 1
+        return cls(*args)
+
+    def sleep(self, obj, wake_on=None):
+        """Stops calling obj.advance() from the next frame, until wake() is
+        called, something moves into obj and one of them reacts, or an instance
+        of wake_on is added"""
+        obj.sleeping = True
+        obj.wake_on = wake_on
+        if wake_on is not None:
+            self.waiting.setdefault(wake_on, []).append(obj)
+
+    def wake(self, obj):
+        "Starts calling obj.advance() again from the next frame"
+        if not obj.sleeping:
+            return
+        obj.sleeping = False
+        obj.wake_on = None
+        if obj in self.order and not obj.static:
+            self.woken.append(obj)
+
+    def schedule(self):
+        "Returns the objects to advance this frame"
+        if self.woken:
+            awake = set(self.awake)
+            awake.update(self.woken)
+            self.awake = sorted(awake, key=self.order.__getitem__)
+            self.woken = []
+        return self.awake
+
+    def count(self, cls):
+        "Returns the number of objects that are instances of cls"
+        return self.types.count(cls)
+
+    def instances(self, cls):
+        "Returns the objects that are instances of cls, in the order of self.objects"
+        return self.types.instances(cls)
+
+    def remove_objects(self, objs):
+        "Takes objects out of play without killing them"
+        objs = set(objs)
+        if not objs:
+            return
+        self.objects = [obj for obj in self.objects if obj not in objs]
+        self.awake = [obj for obj in self.awake if obj not in objs]
+        if self.woken:
+            self.woken = [obj for obj in self.woken if obj not in objs]
+        for cls, waiters in self.waiting.items():
+            waiters = [obj for obj in waiters if obj not in objs]
+            if waiters:
+                self.waiting[cls] = waiters
+            else:
+                del self.waiting[cls]
+        self.types.remove_all(objs)
+        self.grid.remove_all(objs)
+        for obj in objs:
+            del self.order[obj]
+
+    def view(self):
+        """Returns (x, y, width, height) of the part of the playing area shown on
+        the screen, which is all of it unless a world has a camera"""
+        if self.world is not None:
+            return self.world.camera
+        return (0, 0, self.width, self.height)
+
+    def set_tiles(self, xtiles, ytiles, tilewidth, tileheight, solid):
+        """Changes the size of the playing area, and sets which tiles are walls
+        from a sequence with a true value for each solid tile, row by row"""
+        if len(solid) != xtiles * ytiles:
+            raise ValueError("expected %d tiles, got %d" % (xtiles * ytiles, len(solid)))
+
+        self.xtiles = xtiles
+        self.ytiles = ytiles
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.width = self.tilewidth * self.xtiles
+        self.height = self.tileheight * self.ytiles
 
-        for obj in self.objects:
-            reqs = obj.advance(self, inputs)
-            for i in reqs:
-                if isinstance(i, tuple):
-                    if i[0] == ADD:
-                        to_add.append(i[1])
+        self.solid = bytearray(1 if x else 0 for x in solid)
+        if not any(self.solid):
+            self.solid = bytearray()
+        self.tiles_version += 1
+
+        if (self.grid.cellwidth, self.grid.cellheight) != (tilewidth, tileheight):
+            self.grid = SpatialHash(self.tilewidth, self.tileheight)
+            for obj in self.objects:
+                if isinstance(obj, Moveable):
+                    self.grid.insert(obj)
+
+    def set_solid(self, tx, ty, xtiles, solid):
+        """Sets which tiles are walls in a rectangle xtiles wide with its top left
+        corner at tile (tx, ty), from a sequence with a value for each tile, row
+        by row"""
+        if not self.solid:
+            if not any(solid):
+                return
+            self.solid = bytearray(self.xtiles * self.ytiles)
+        for i in range(0, len(solid), xtiles):
+            start = (ty + i / xtiles) * self.xtiles + tx
+            self.solid[start:start + xtiles] = bytearray(1 if x else 0 for x in solid[i:i + xtiles])
+        self.tiles_version += 1
+
+    def solid_boxes(self, left, top, right, bottom):
+        "Returns (x, y, width, height) for each solid tile under the given pixels"
+        tw = self.tilewidth
+        th = self.tileheight
+        result = []
+        for ty in range(max(top // th, 0), min(bottom // th, self.ytiles - 1) + 1):
+            row = ty * self.xtiles
+            for tx in range(max(left // tw, 0), min(right // tw, self.xtiles - 1) + 1):
+                if self.solid[row + tx]:
+                    result.append((tx * tw, ty * th, tw, th))
+        return result
+
+    def snapshot(self):
+        return Snapshot(self)
+
+    def restore(self, snapshot):
+        "Returns to the frame at which snapshot was taken"
+        for obj, attributes in zip(snapshot.objects, snapshot.attributes):
+            if attributes is None:
+                obj.dead = False
+            else:
+                set_attributes(obj, attributes)
+        self.random.setstate(snapshot.random_state)
+        self.frame = snapshot.frame
+        self.deferred = dict((due, list(objs)) for (due, objs) in snapshot.deferred.iteritems())
 
-        for i in range(len(self.objects)-1, -1, -1):
-            if self.objects[i].dead:
-                self.objects.pop(i)
+        self.objects = []
+        self.grid = SpatialHash(self.tilewidth, self.tileheight)
+        self.types = TypeIndex()
+        self.reset_schedule()
+        self.add_all(snapshot.objects)
 
-        for obj in to_add:
-            self.objects.append(obj)
+        if self.world is not None and snapshot.world is not None:
+            self.world.restore(self, snapshot.world)
 
-        return ()
+    def moved(self, obj):
+        "Must be called when an object's position is changed outside of Moveable.move"
+        self.grid.update(obj)
 
+    def advance(self, inputs):
+        """Returns the state at the next frame and any control requests (sounds,
+         quit, etc.)"""
+        if self.profile is not None:
+            return self.advance_profiled(inputs)
+
+        commands = Commands()
+        awake = self.schedule()
+        batch = self.projectiles
+        if batch is not None:
+            batch.prepare(self, inputs, awake)
+
+        for obj in awake:
+            if obj.sleeping:
+                # put to sleep by an object before it this frame
+                continue
+            if batch is not None and obj in batch.plans and batch.step(self, obj, inputs):
+                reqs = ()
+            else:
+                reqs = obj.advance(self, inputs)
+            # advance() may have placed the object directly
+            self.grid.update(obj)
+            if reqs:
+                commands.extend(reqs)
+
+        self.apply(commands, awake)
+
+        if self.world is not None:
+            self.world.update(self)
+
+        return commands.other
+
+    def advance_profiled(self, inputs):
+        "Does the same as advance(), recording a FrameStats in self.profile"
+        timer = timeit.default_timer
+        frame_start = timer()
+        stats = self.stats = FrameStats()
+        commands = Commands()
+        awake = self.schedule()
+        batch = self.projectiles
+        if batch is not None:
+            batch.prepare(self, inputs, awake)
+
+        for obj in awake:
+            if obj.sleeping:
+                continue
+            cls = type(obj)
+            start = timer()
+            if batch is not None and obj in batch.plans and batch.step(self, obj, inputs):
+                reqs = ()
+            else:
+                reqs = obj.advance(self, inputs)
+            stats.advance_time[cls] = stats.advance_time.get(cls, 0.0) + timer() - start
+            stats.advance_count[cls] = stats.advance_count.get(cls, 0) + 1
+            self.grid.update(obj)
+            if reqs:
+                commands.extend(reqs)
+
+        removed, added = self.apply(commands, awake)
+        for objs, counts in ((removed, stats.removed), (added, stats.added)):
+            for obj in objs:
+                cls = type(obj)
+                counts[cls] = counts.get(cls, 0) + 1
+
+        if self.world is not None:
+            self.world.update(self)
+
+        self.stats = None
+        stats.time = timer() - frame_start
+        self.profile.frames.append(stats)
+
+        return commands.other
+
+    def apply(self, commands, advanced):
+        """Carries out the Commands collected while advancing the objects in
+        advanced, ending the frame, and returns the objects removed and added.
+
+        Dead objects are removed in one pass over self.objects, and new ones
+        are added together, so the indexes are updated in bulk."""
+        candidates = advanced
+        if commands.deleted:
+            for obj in commands.deleted:
+                obj.kill()
+            candidates = list(advanced)
+            candidates.extend(obj for obj in commands.deleted if obj in self.order)
+
+        for frames, obj in commands.deferred:
+            self.deferred.setdefault(self.frame + frames, []).append(obj)
+        added = self.deferred.pop(self.frame, [])
+        added.extend(commands.added)
+        self.frame += 1
+
+        removed = self.remove_dead(candidates)
+        self.add_all(added)
+        return removed, added
+
+    def remove_dead(self, candidates=None):
+        """Removes dead objects, returning them, and drops objects that have gone
+        to sleep from awake. Only objects in candidates are checked, if given:
+        the objects advanced this frame and the ones they woke by moving into
+        them are the only ones that could have been killed."""
+        if candidates is None:
+            candidates = self.objects
+        removed = [obj for obj in candidates if obj.dead]
+        removed.extend(obj for obj in self.woken if obj.dead and obj in self.order)
+        if removed:
+            dead = set(removed)
+            removed = sorted(dead, key=self.order.__getitem__, reverse=True)
+            self.objects = [obj for obj in self.objects if obj not in dead]
+            self.types.remove_all(removed)
+            self.grid.remove_all(removed)
+            for obj in removed:
+                del self.order[obj]
+            self.woken = [obj for obj in self.woken if not obj.dead]
+
+        # a renderer may still have this frame's dead objects, so they wait a
+        # frame before they can come back as new ones
+        free = self.free
+        for obj in self.dying:
+            free.setdefault(type(obj), []).append(obj)
+        self.dying = [obj for obj in removed if obj.pooled]
+
+        if removed or any(obj.sleeping for obj in self.awake):
+            self.awake = [obj for obj in self.awake if not obj.sleeping and not obj.dead]
+        return removed
@@ -22,23 +22,19 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import math
+import timeit
 
 import pygame
 
 import gamelogic
 
-def draw_ball(surface, state, obj):
-    width, height = surface.get_size()
+FRAME_TIME = 0.02       # seconds between frames of game logic
+MAX_CATCH_UP = 5        # most frames of game logic to run before each draw
+MAX_DRAW_RATE = 200     # most draws per second
 
+def render_ball(surface, left, top, right, bottom, thickness, angle):
     color = pygame.Color(255, 127, 0)
 
-    left = width * obj.x / state.width
-    right = width * (obj.x + obj.width) / state.width
-    top = height * obj.y / state.height
-    bottom = height * (obj.y + obj.height) / state.height
-
-    thickness = width / state.width
-
     top_pt = ((left+right)/2-thickness, top)
     bottom_pt = ((left+right)/2-thickness, bottom)
 
@@ -48,16 +44,9 @@ def draw_ball(surface, state, obj):
 
     pygame.draw.ellipse(surface, color, pygame.Rect((left+right)/2, top, (right-left)/2, (bottom-top)/2), thickness)
 
-def draw_plunger(surface, state, obj):
-    width, height = surface.get_size()
-
+def render_plunger(surface, left, top, right, bottom, thickness, angle):
     color = pygame.Color(0, 196, 0)
 
-    left = width * obj.x / state.width
-    right = width * (obj.x + obj.width) / state.width
-    top = height * obj.y / state.height
-    bottom = height * (obj.y + obj.height) / state.height
-
     rect = pygame.Rect(left, top, right-left, bottom-top)
 
     x_center = (left+right)/2
@@ -66,16 +55,14 @@ def draw_plunger(surface, state, obj):
     y_center = (top+bottom)/2
     y_mult = (bottom-top)/2
 
-    sin_angle = math.sin(obj.angle)
-    cos_angle = math.cos(obj.angle)
+    sin_angle = math.sin(angle)
+    cos_angle = math.cos(angle)
 
     tip = (int(x_center+x_mult*cos_angle), int(y_center+y_mult*sin_angle))
     back = (int(x_center-x_mult*cos_angle), int(y_center-y_mult*sin_angle))
     side1 = (int(x_center+x_mult*sin_angle*0.8), int(y_center-y_mult*cos_angle*0.8))
     side2 = (int(x_center-x_mult*sin_angle*0.8), int(y_center+y_mult*cos_angle*0.8))
 
-    thickness = width / state.width
-
     pygame.draw.line(surface, color, tip, back, thickness)
     pygame.draw.line(surface, color, tip, side1, thickness)
     pygame.draw.line(surface, color, tip, side2, thickness)
@@ -83,54 +70,502 @@ def draw_plunger(surface, state, obj):
 
     pygame.draw.rect(surface, pygame.Color(0, 64, 0), rect, thickness)
 
+class SpriteCache(object):
+    """Images of objects drawn by a render function, so that drawing an object
+    only takes a blit.
+
+    Images are kept for each render function, object size and angle, with the
+    angle rounded to one of ANGLE_STEPS. The cache is emptied when the scale of
+    the screen changes, and the least recently used image is dropped when there
+    are more than size of them."""
+
+    ANGLE_STEPS = 64
+
+    def __init__(self, size=256):
+        self.size = size
+        self.sprites = {}       # key -> [image, margin, time of last use]
+        self.clock = 0
+        self.scale = None
+
+    def get(self, surface, state, render, obj, angle=None):
+        """Returns a surface with obj drawn on it, and the distance from the
+        corner of that surface to the corner of the object"""
+        left, top, view_width, view_height = state.view()
+        scale = (surface.get_size(), view_width, view_height)
+        if scale != self.scale:
+            self.sprites.clear()
+            self.scale = scale
+
+        if angle is not None:
+            angle = int(round(angle * self.ANGLE_STEPS / (math.pi * 2))) % self.ANGLE_STEPS
+        key = (render, obj.width, obj.height, angle)
+
+        self.clock += 1
+        try:
+            sprite = self.sprites[key]
+        except KeyError:
+            if len(self.sprites) >= self.size:
+                del self.sprites[min(self.sprites, key=lambda k: self.sprites[k][2])]
+            sprite = self.sprites[key] = self.render(surface, state, render, obj, angle)
+        sprite[2] = self.clock
+        return sprite[0], sprite[1]
+
+    def render(self, surface, state, render, obj, angle):
+        width, height = surface.get_size()
+        left, top, view_width, view_height = state.view()
+        thickness = width / view_width
+        right = width * obj.width / view_width
+        bottom = height * obj.height / view_height
+
+        # leave room for thick lines to spill over the edges of the object
+        margin = thickness
+        image = pygame.Surface((right + margin * 2 + 1, bottom + margin * 2 + 1))
+        image.fill(pygame.Color(0, 0, 0))
+        if angle is not None:
+            angle = angle * math.pi * 2 / self.ANGLE_STEPS
+        render(image, margin, margin, right + margin, bottom + margin, thickness, angle)
+        image.set_colorkey(pygame.Color(0, 0, 0), pygame.RLEACCEL)
+        if pygame.display.get_surface() is not None:
+            image = image.convert()
+        return [image, margin, 0]
+
+# set to None to draw every object with pygame.draw
+sprites = SpriteCache()
+
+def draw_sprite(surface, state, render, obj, x, y, angle=None):
+    width, height = surface.get_size()
+    view_x, view_y, view_width, view_height = state.view()
+
+    left = width * (x - view_x) / view_width
+    top = height * (y - view_y) / view_height
+
+    if sprites is not None:
+        image, margin = sprites.get(surface, state, render, obj, angle)
+        surface.blit(image, (int(left) - margin, int(top) - margin))
+    else:
+        right = width * (x + obj.width - view_x) / view_width
+        bottom = height * (y + obj.height - view_y) / view_height
+        render(surface, left, top, right, bottom, width / view_width, angle)
+
+def draw_ball(surface, state, obj, x, y):
+    draw_sprite(surface, state, render_ball, obj, x, y)
+
+def draw_plunger(surface, state, obj, x, y):
+    draw_sprite(surface, state, render_plunger, obj, x, y, obj.angle)
+
 object_draw_functions = {
     gamelogic.Ball: draw_ball,
     gamelogic.Plunger: draw_plunger,
     }
 
-def draw_unknown(surface, state, obj):
-    if isinstance(obj, gamelogic.Moveable):
-        width, height = surface.get_size()
-
-        color = pygame.Color(255, 0, 0)
-
-        left = width * obj.x / state.width
-        right = width * (obj.x + obj.width) / state.width
-        top = height * obj.y / state.height
-        bottom = height * (obj.y + obj.height) / state.height
+def render_unknown(surface, left, top, right, bottom, thickness, angle):
+    color = pygame.Color(255, 0, 0)
 
-        thickness = width / state.width
+    pygame.draw.line(surface, color, (left, top), (right, top), thickness)
+    pygame.draw.line(surface, color, (left, bottom), (right, bottom), thickness)
 
-        pygame.draw.line(surface, color, (left, top), (right, top), thickness)
-        pygame.draw.line(surface, color, (left, bottom), (right, bottom), thickness)
+    pygame.draw.line(surface, color, (left, top), (left, bottom), thickness)
+    pygame.draw.line(surface, color, (right, top), (right, bottom), thickness)
 
-        pygame.draw.line(surface, color, (left, top), (left, bottom), thickness)
-        pygame.draw.line(surface, color, (right, top), (right, bottom), thickness)
+    pygame.draw.line(surface, color, (left, top), (right, bottom), thickness)
+    pygame.draw.line(surface, color, (left, bottom), (right, top), thickness)
 
-        pygame.draw.line(surface, color, (left, top), (right, bottom), thickness)
-        pygame.draw.line(surface, color, (left, bottom), (right, top), thickness)
+def draw_unknown(surface, state, obj, x, y):
+    if isinstance(obj, gamelogic.Moveable):
+        draw_sprite(surface, state, render_unknown, obj, x, y)
 
-def draw_object(surface, state, obj):
+def draw_object(surface, state, obj, x, y):
     try:
         f = object_draw_functions[type(obj)]
     except KeyError:
         f = draw_unknown
-    f(surface, state, obj)
-
-def draw(surface, state):
+    f(surface, state, obj, x, y)
+
+def positions(state):
+    "Returns the positions of the Moveables in state, for draw() to interpolate from"
+    return dict((obj, (obj.x, obj.y)) for obj in state.objects if isinstance(obj, gamelogic.Moveable))
+
+def blit_all(surface, blits):
+    "Draws a list of (image, position, area) in one call where pygame allows"
+    if hasattr(surface, 'blits'):
+        surface.blits(blits, False)
+    else:
+        blit = surface.blit
+        for image, pos, area in blits:
+            blit(image, pos, area)
+
+def draw_background(surface, state):
+    "Draws the parts of the screen that don't change from frame to frame"
     width, height = surface.get_size()
+    view_x, view_y, view_width, view_height = state.view()
+    tw = state.tilewidth
+    th = state.tileheight
+
+    def tile_left(tx):
+        return width * (tx * tw - view_x) / view_width
+
+    def tile_top(ty):
+        return height * (ty * th - view_y) / view_height
+
+    first_tx = view_x // tw
+    last_tx = (view_x + view_width - 1) // tw
+    first_ty = view_y // th
+    last_ty = (view_y + view_height - 1) // th
 
     surface.fill(pygame.Color(0, 0, 0))
 
+    if state.world is not None:
+        # worlds are drawn from their tilesets, without the tiles objects spawn from
+        images = state.world.tilemap.background_images(-(-width * tw // view_width), -(-height * th // view_height))
+        blits = []
+        for tx, ty, gid in state.world.tiles(first_tx, first_ty, last_tx, last_ty):
+            if gid < len(images) and images[gid] is not None:
+                image, rect = images[gid]
+                blits.append((image, (tile_left(tx), tile_top(ty)), rect))
+        blit_all(surface, blits)
+        return
+
+    if state.tilemap is not None:
+        for layer in state.tilemap.layers:
+            draw_tile_layer(surface, state.tilemap, layer)
+        return
+
     # draw a grid background for now
     gridcolor = pygame.Color(30, 30, 30)
-    for i in range(state.xtiles):
-        pygame.draw.line(surface, gridcolor, (width * i / state.xtiles, 0), (width * i / state.xtiles, height), (width / state.width))
-    for i in range(state.ytiles):
-        pygame.draw.line(surface, gridcolor, (0, height * i / state.ytiles), (width, height * i / state.ytiles), (height / state.height))
+    for i in range(first_tx, last_tx + 1):
+        pygame.draw.line(surface, gridcolor, (tile_left(i), 0), (tile_left(i), height), (width / view_width))
+    for i in range(first_ty, last_ty + 1):
+        pygame.draw.line(surface, gridcolor, (0, tile_top(i)), (width, tile_top(i)), (height / view_height))
+
+    wallcolor = pygame.Color(90, 90, 90)
+    for i, solid in enumerate(state.solid):
+        if solid:
+            tx = i % state.xtiles
+            ty = i / state.xtiles
+            if first_tx <= tx <= last_tx and first_ty <= ty <= last_ty:
+                left = tile_left(tx)
+                top = tile_top(ty)
+                pygame.draw.rect(surface, wallcolor, pygame.Rect(left, top,
+                    tile_left(tx + 1) - left, tile_top(ty + 1) - top))
+
+def draw_tile_layer(surface, tilemap, layer):
+    """Draws a mapformat.TileLayer from tilemap, scaled to fill surface, using
+    one batched blit from the tilesets' scaled atlases, leaving out the tiles
+    that stand for objects"""
+    width, height = surface.get_size()
+
+    # tiles are drawn at the largest size any of them has on the screen, so
+    # neighbours overlap by a pixel rather than leaving gaps
+    tilewidth = -(-width // layer.width)
+    tileheight = -(-height // layer.height)
+    images = tilemap.background_images(tilewidth, tileheight)
+
+    blits = []
+    for i, gid in enumerate(layer.tiles):
+        if gid and gid < len(images) and images[gid] is not None:
+            image, rect = images[gid]
+            tx = i % layer.width
+            ty = i / layer.width
+            blits.append((image, (width * tx / layer.width, height * ty / layer.height), rect))
+
+    blit_all(surface, blits)
+
+def draw_chunk(world, key, width, height, view_width, view_height):
+    """Returns an image of the tiles of a world's chunk, less those objects
+    spawn from, at the scale they have on a width by height surface showing
+    view_width by view_height pixels"""
+    chunk = world.chunk(key)
+    tw = world.tilemap.tilewidth
+    th = world.tilemap.tileheight
+    left = chunk.tx * tw
+    top = chunk.ty * th
+
+    image = pygame.Surface((-(-chunk.xtiles * tw * width // view_width),
+                            -(-chunk.ytiles * th * height // view_height)))
+    if pygame.display.get_surface() is not None:
+        image = image.convert()
+    image.fill(pygame.Color(0, 0, 0))
+
+    images = world.tilemap.background_images(-(-width * tw // view_width), -(-height * th // view_height))
+    blits = []
+    for tx, ty, gid in world.tiles(chunk.tx, chunk.ty, chunk.tx + chunk.xtiles - 1, chunk.ty + chunk.ytiles - 1):
+        if gid < len(images) and images[gid] is not None:
+            tile, rect = images[gid]
+            blits.append((tile, (width * (tx * tw - left) / view_width, height * (ty * th - top) / view_height), rect))
+    blit_all(image, blits)
+    return image
+
+class BackgroundCache(object):
+    """Keeps the output of draw_background, redrawing it only when it would change.
+
+    A world's background is put together from an image of each chunk under the
+    camera, and those are kept while they are near it, so scrolling only costs
+    a blit for each chunk."""
+
+    def __init__(self):
+        self.key = None
+        self.surface = None
+        self.version = 0        # changes whenever surface is redrawn
+        self.chunk_key = None
+        self.chunk_images = {}  # chunk key -> image from draw_chunk()
+
+    def new_surface(self, size):
+        if self.surface is None or self.surface.get_size() != size:
+            self.surface = pygame.Surface(size)
+            if pygame.display.get_surface() is not None:
+                self.surface = self.surface.convert()
+        return self.surface
+
+    def get(self, surface, state):
+        if state.world is not None:
+            return self.get_world(surface, state)
+
+        key = (surface.get_size(), state.xtiles, state.ytiles, state.tiles_version, state.view())
+        if key != self.key:
+            draw_background(self.new_surface(key[0]), state)
+            self.key = key
+            self.version += 1
+        return self.surface
+
+    def get_world(self, surface, state):
+        world = state.world
+        width, height = size = surface.get_size()
+        view_x, view_y, view_width, view_height = state.view()
+
+        chunk_key = (size, world, view_width, view_height)
+        if chunk_key != self.chunk_key:
+            self.chunk_images = {}
+            self.chunk_key = chunk_key
+
+        key = (chunk_key, view_x, view_y)
+        if key == self.key:
+            return self.surface
+
+        result = self.new_surface(size)
+        result.fill(pygame.Color(0, 0, 0))
+        tw = world.tilemap.tilewidth
+        th = world.tilemap.tileheight
+        for chunk in sorted(world.chunk_range(0)):
+            try:
+                image = self.chunk_images[chunk]
+            except KeyError:
+                image = self.chunk_images[chunk] = draw_chunk(world, chunk, width, height, view_width, view_height)
+            tx = chunk[0] * world.chunk_xtiles
+            ty = chunk[1] * world.chunk_ytiles
+            result.blit(image, (width * (tx * tw - view_x) / view_width, height * (ty * th - view_y) / view_height))
+
+        near = world.chunk_range(1)
+        for chunk in self.chunk_images.keys():
+            if chunk not in near:
+                del self.chunk_images[chunk]
+
+        self.key = key
+        self.version += 1
+        return result
+
+background = BackgroundCache()
+
+def screen_rect(surface, state, obj, x, y):
+    "Returns the area of surface that draw_object may change"
+    width, height = surface.get_size()
+    view_x, view_y, view_width, view_height = state.view()
+    thickness = width / view_width
 
+    left = int(width * (x - view_x) / view_width) - thickness
+    top = int(height * (y - view_y) / view_height) - thickness
+    right = int(width * (x + obj.width - view_x) / view_width) + thickness
+    bottom = int(height * (y + obj.height - view_y) / view_height) + thickness
+
+    return pygame.Rect(left, top, right - left + 1, bottom - top + 1)
+
+def object_positions(state, previous=None, alpha=1.0):
+    """Yields each object in state with the position to draw it at. If previous
+    is the result of positions() for the frame before, objects are placed alpha
+    of the way from their old positions to their new ones."""
     for obj in state.objects:
-        draw_object(surface, state, obj)
+        try:
+            x, y = previous[obj]
+        except (KeyError, TypeError):
+            yield obj, getattr(obj, 'x', 0), getattr(obj, 'y', 0)
+            continue
+        dx = obj.x - x
+        dy = obj.y - y
+        if abs(dx) > state.tilewidth * 2 or abs(dy) > state.tileheight * 2:
+            # don't drag teleporting objects across the screen
+            dx = dy = 0
+            x = obj.x
+            y = obj.y
+        yield obj, x + dx * alpha, y + dy * alpha
+
+def draw_world(surface, state, previous=None, alpha=1.0):
+    "Draws the background and objects of state, scaled to fill surface"
+    surface.blit(background.get(surface, state), (0, 0))
+
+    for obj, x, y in object_positions(state, previous, alpha):
+        draw_object(surface, state, obj, x, y)
+
+def draw(surface, state, previous=None, alpha=1.0):
+    "Draws state straight onto surface, working out the scale for every shape"
+    draw_world(surface, state, previous, alpha)
+
+    if state.profile is not None:
+        draw_profile(surface, state.profile)
+
+class Renderer(object):
+    """Draws the game on the screen for run(), using draw().
+
+    draw() returns the areas of the screen to update, or None if the whole
+    screen should be flipped."""
+
+    def draw(self, screen, state, previous=None, alpha=1.0):
+        draw(screen, state, previous, alpha)
+
+    def invalidate(self):
+        "Must be called after something else draws on the screen"
+        pass
+
+class LogicalRenderer(Renderer):
+    """Draws at the game's own resolution, the size of state.view(), and then
+    scales that image to the screen in one go. With integer_scale, the image
+    is only scaled by whole numbers and centered, so every game pixel becomes
+    the same number of screen pixels."""
+
+    def __init__(self, integer_scale=False):
+        self.integer_scale = integer_scale
+        self.surface = None
+
+    def draw(self, screen, state, previous=None, alpha=1.0):
+        view_x, view_y, view_width, view_height = state.view()
+        size = (view_width, view_height)
+        if self.surface is None or self.surface.get_size() != size:
+            self.surface = pygame.Surface(size)
+            if pygame.display.get_surface() is not None:
+                self.surface = self.surface.convert()
+
+        draw_world(self.surface, state, previous, alpha)
+
+        width, height = screen.get_size()
+        if self.integer_scale:
+            factor = max(1, min(width / view_width, height / view_height))
+            rect = pygame.Rect(0, 0, view_width * factor, view_height * factor)
+            rect.center = (width / 2, height / 2)
+            rect = rect.clip(screen.get_rect())
+            screen.fill(pygame.Color(0, 0, 0))
+            pygame.transform.scale(self.surface, rect.size, screen.subsurface(rect))
+        else:
+            pygame.transform.scale(self.surface, (width, height), screen)
+
+        if state.profile is not None:
+            draw_profile(screen, state.profile)
+
+class DirtyRectRenderer(Renderer):
+    """Draws like draw(), but only redraws the parts of the screen covered by
+    objects that moved, appeared or disappeared since the last draw, and only
+    those parts are updated on the display.
+
+    If more than max_dirty of the screen would be redrawn, or there is an
+    overlay, everything is drawn and the whole screen is flipped instead.
+
+    Objects are redrawn clipped to the changed areas. That matches a full
+    redraw exactly when they are drawn from sprites, but thick pygame.draw
+    lines can come out slightly differently when clipped."""
+
+    def __init__(self, max_dirty=0.4):
+        self.max_dirty = max_dirty
+        self.rects = {}         # object -> area of the screen it was drawn in
+        self.angles = {}        # object -> angle it was drawn at
+        self.key = None
+
+    def invalidate(self):
+        self.key = None
+
+    def draw(self, screen, state, previous=None, alpha=1.0):
+        bg = background.get(screen, state)
+
+        placed = []
+        rects = {}
+        angles = {}
+        for obj, x, y in object_positions(state, previous, alpha):
+            if isinstance(obj, gamelogic.Moveable):
+                rect = rects[obj] = screen_rect(screen, state, obj, x, y)
+                angles[obj] = getattr(obj, 'angle', None)
+            else:
+                rect = pygame.Rect(0, 0, 0, 0)
+            placed.append((obj, x, y, rect))
+
+        key = (screen.get_size(), background.version)
+        full = key != self.key or state.profile is not None
+
+        dirty = []
+        if not full:
+            # an object that turned on the spot needs redrawing too
+            for obj, rect in self.rects.iteritems():
+                if rects.get(obj) != rect or angles[obj] != self.angles[obj]:
+                    dirty.append(rect)
+            for obj, rect in rects.iteritems():
+                if self.rects.get(obj) != rect:
+                    dirty.append(rect)
+
+            width, height = screen.get_size()
+            if sum(rect.width * rect.height for rect in dirty) > self.max_dirty * width * height:
+                full = True
+
+        self.rects = rects
+        self.angles = angles
+        self.key = key
+
+        if full:
+            screen.blit(bg, (0, 0))
+            for obj, x, y, rect in placed:
+                draw_object(screen, state, obj, x, y)
+            if state.profile is not None:
+                draw_profile(screen, state.profile)
+            return None
+
+        object_rects = [rect for obj, x, y, rect in placed]
+        screen_area = screen.get_rect()
+        updates = []
+        for rect in dirty:
+            rect = rect.clip(screen_area)
+            if not rect:
+                continue
+            screen.set_clip(rect)
+            screen.blit(bg, rect, rect)
+            for i in rect.collidelistall(object_rects):
+                obj, x, y, obj_rect = placed[i]
+                draw_object(screen, state, obj, x, y)
+            updates.append(rect)
+        screen.set_clip(None)
+
+        return updates
+
+profile_font = None
+
+def draw_profile(surface, profile):
+    "Draws the recent averages from a gamelogic.Profile in the top left corner"
+    global profile_font
+
+    if not pygame.font:
+        return
+    if profile_font is None:
+        profile_font = pygame.font.Font(None, 18)
+
+    stats = profile.summary()
+
+    lines = ["frame %.2fms" % (stats.time * 1000)]
+    for cls, time in sorted(stats.advance_time.items(), key=lambda x: -x[1]):
+        lines.append("%s: %.2fms x%.0f" % (cls.__name__, time * 1000, stats.advance_count[cls]))
+    lines.append("candidates: %.0f" % stats.candidates)
+    lines.append("collide: up %.0f down %.0f left %.0f right %.0f" % (
+        stats.collisions[gamelogic.UP], stats.collisions[gamelogic.DOWN],
+        stats.collisions[gamelogic.LEFT], stats.collisions[gamelogic.RIGHT]))
+    lines.append("added: %.2f removed: %.2f" % (sum(stats.added.values()), sum(stats.removed.values())))
+
+    y = 2
+    for line in lines:
+        text = profile_font.render(line, 1, (240, 240, 0))
+        surface.blit(text, (2, y))
+        y += text.get_height()
 
 def draw_paused(surface):
     if pygame.font:
@@ -139,24 +574,53 @@ def draw_paused(surface):
         textpos = text.get_rect(centerx=surface.get_width()/2, centery=surface.get_height()/2)
         surface.blit(text, textpos)
 
-def run(screen, state):
+def run(screen, state, recorder=None, replay=None, frame=0, throttle=True, render_every=1, renderer=None):
+    """Plays the game in state until the user quits.
+
+    Frames of game logic run at a fixed rate of one per FRAME_TIME, however
+    often the screen is drawn. Before each draw, all the frames that have come
+    due are run, up to MAX_CATCH_UP of them, and objects are drawn between
+    their positions in the last two frames.
+
+    If recorder is given, it is passed the inputs of every frame. If replay is
+    given, the inputs are instead taken from that replay.Recording, starting at
+    frame, and the game ends when they run out. throttle=False runs one frame
+    per draw as fast as possible, and render_every=N only draws when N frames
+    have passed.
+
+    renderer is the Renderer used to draw the game, by default one that uses
+    draw()."""
     width, height = screen.get_size()
 
+    if renderer is None:
+        renderer = Renderer()
+
     clock = pygame.time.Clock()
+    timer = timeit.default_timer
 
     pygame.mouse.set_visible(False)
     pygame.event.set_grab(True)
 
     try:
         dx_rem = dy_rem = 0
+        mouse_dx = mouse_dy = 0
         buttons_pressed = set()
         keys_pressed = set()
         paused = False
+        previous = None
+        lag = 0.0
+        last_time = timer()
+        drawn_frame = frame
 
         while 1:
-            clock.tick(50)
-
-            inputs = gamelogic.Inputs()
+            if throttle:
+                clock.tick(MAX_DRAW_RATE)
+                now = timer()
+                lag += now - last_time
+                last_time = now
+                frames_due = min(int(lag / FRAME_TIME), MAX_CATCH_UP)
+            else:
+                frames_due = 1
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -169,41 +633,81 @@ def run(screen, state):
                         paused = not paused
                         pygame.mouse.set_visible(paused)
                         pygame.event.set_grab(not paused)
+                    elif event.key == pygame.K_F3:
+                        if state.profile is None:
+                            state.profile = gamelogic.Profile()
+                        else:
+                            state.profile = None
                 elif event.type == pygame.KEYUP:
                     keys_pressed.remove(event.key)
                 elif event.type == pygame.MOUSEMOTION:
                     dx, dy = event.rel
-                    inputs.dx += dx
-                    inputs.dy += dy
+                    mouse_dx += dx
+                    mouse_dy += dy
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     buttons_pressed.add(event.button)
                 elif event.type == pygame.MOUSEBUTTONUP:
                     buttons_pressed.remove(event.button)
 
-            if pygame.K_w in keys_pressed: inputs.dy -= 6
-            if pygame.K_a in keys_pressed: inputs.dx -= 6
-            if pygame.K_s in keys_pressed: inputs.dy += 6
-            if pygame.K_d in keys_pressed: inputs.dx += 6
-
-            if pygame.K_UP in keys_pressed: inputs.dy -= 6
-            if pygame.K_LEFT in keys_pressed: inputs.dx -= 6
-            if pygame.K_DOWN in keys_pressed: inputs.dy += 6
-            if pygame.K_RIGHT in keys_pressed: inputs.dx += 6
-
-            inputs.dx, dx_rem = divmod(inputs.dx * state.width + dx_rem, width)
-            inputs.dy, dy_rem = divmod(inputs.dy * state.height + dy_rem, height)
-            inputs.buttons_pressed = buttons_pressed
-
-            if not paused:
-                requests = state.advance(inputs)
-
-            draw(screen, state)
-
             if paused:
-                draw_paused(screen)
-
-            pygame.display.flip()
+                frames_due = 0
+                lag = 0.0
+                previous = None
+
+            for i in range(frames_due):
+                inputs = gamelogic.Inputs()
+                inputs.dx = mouse_dx
+                inputs.dy = mouse_dy
+                mouse_dx = mouse_dy = 0
+
+                if pygame.K_w in keys_pressed: inputs.dy -= 6
+                if pygame.K_a in keys_pressed: inputs.dx -= 6
+                if pygame.K_s in keys_pressed: inputs.dy += 6
+                if pygame.K_d in keys_pressed: inputs.dx += 6
+
+                if pygame.K_UP in keys_pressed: inputs.dy -= 6
+                if pygame.K_LEFT in keys_pressed: inputs.dx -= 6
+                if pygame.K_DOWN in keys_pressed: inputs.dy += 6
+                if pygame.K_RIGHT in keys_pressed: inputs.dx += 6
+
+                view_x, view_y, view_width, view_height = state.view()
+                inputs.dx, dx_rem = divmod(inputs.dx * view_width + dx_rem, width)
+                inputs.dy, dy_rem = divmod(inputs.dy * view_height + dy_rem, height)
+                inputs.buttons_pressed = buttons_pressed
+
+                if replay is not None:
+                    if frame >= len(replay):
+                        return 0
+                    inputs = replay.inputs(frame)
+
+                if recorder is not None:
+                    recorder.record(state, inputs)
+                if i == frames_due - 1:
+                    previous = positions(state)
+                state.advance(inputs)
+                frame += 1
+
+            if throttle:
+                lag -= frames_due * FRAME_TIME
+                # if we couldn't keep up, drop the time rather than falling further behind
+                lag = min(lag, FRAME_TIME)
+                alpha = lag / FRAME_TIME
+            else:
+                alpha = 1.0
+
+            if paused or render_every == 1 or frame - drawn_frame >= render_every:
+                rects = renderer.draw(screen, state, previous, alpha)
+                drawn_frame = frame
+
+                if paused:
+                    draw_paused(screen)
+                    renderer.invalidate()
+                    rects = None
+
+                if rects is None:
+                    pygame.display.flip()
+                elif rects:
+                    pygame.display.update(rects)
     finally:
         pygame.event.set_grab(False)
         pygame.mouse.set_visible(True)
-
@@ -23,28 +23,63 @@
 
 import pygame
 
+import optparse
+import random
 import sys
 
-import gamelogic
 import gameplay
+import replay
+import scenarios
 
 def main(argv):
-    pygame.init()
-    screen = pygame.display.set_mode((580,480))
-
-    state = gamelogic.State()
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--record', metavar='FILE',
+        help="save this game's inputs to FILE")
+    parser.add_option('--replay', metavar='FILE',
+        help="play back the game saved in FILE")
+    parser.add_option('--seek', type='int', default=0, metavar='N',
+        help="start the replay at frame N")
+    parser.add_option('--fast', action='store_true',
+        help="replay as fast as possible")
+    parser.add_option('--render-every', type='int', default=1, metavar='N',
+        help="only draw every Nth frame")
+    parser.add_option('--logical', action='store_true',
+        help="draw at the game's resolution and scale it up")
+    parser.add_option('--integer-scale', action='store_true',
+        help="draw at the game's resolution and scale it up by a whole number")
+    parser.add_option('--dirty-rects', action='store_true',
+        help="only redraw the parts of the screen that change")
+    options, args = parser.parse_args(argv[1:])
 
-    player = gamelogic.Plunger(128, 0, 16, 16, gamelogic.UP)
-    state.objects.append(player)
+    replay_file = recorder = None
+    if options.replay:
+        replay_file = replay.Recording(options.replay)
+        try:
+            state = replay_file.state_at(options.seek)
+        except ValueError, e:
+            parser.error(str(e))
+    else:
+        seed = random.getrandbits(32)
+        state = scenarios.build('default', seed)
+        if options.record:
+            recorder = replay.Recorder(options.record, 'default', seed)
 
-    #state.objects.append(gamelogic.Ball(128, 0, 8, 8))
-    #state.objects.append(gamelogic.Generator(gamelogic.Robot, 3, 16, 16, 12544, 2, False))
-    state.objects.append(gamelogic.EscalatingGenerator(gamelogic.Robot, 0, 750, 16, 16, 12544, 2, True))
+    pygame.init()
+    screen = pygame.display.set_mode((580,480))
 
-    for i in range(8, 26, 4):
-        state.objects.append(gamelogic.DaggerBit(player, 3, 3, i))
+    if options.logical or options.integer_scale:
+        renderer = gameplay.LogicalRenderer(options.integer_scale)
+    elif options.dirty_rects:
+        renderer = gameplay.DirtyRectRenderer()
+    else:
+        renderer = gameplay.Renderer()
 
-    gameplay.run(screen, state)
+    try:
+        gameplay.run(screen, state, recorder, replay_file, options.seek,
+                     not options.fast, options.render_every, renderer)
+    finally:
+        if recorder is not None:
+            recorder.close()
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
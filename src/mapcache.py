@@ -0,0 +1,367 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compiled maps, which load much faster than reading the TMX file, decoding its
+layers and evaluating its tilesets' .ini files again. The tileset images are
+still loaded from their own files, through mapformat.load_tileset_image(), so
+maps that share a tileset share one copy of it.
+
+The compiled copy of a map is kept next to it, with 'c' added to the name
+(test.tmx -> test.tmxc). All numbers in it are little-endian:
+  header: magic, format version, length of the metadata
+  metadata: JSON giving the map size, the image file and tile properties of
+    each tileset, where each layer is, and the size, mtime and SHA-1 hash of
+    each source file
+  the tile ids of each layer, as unsigned 32-bit numbers
+  the spawn list from Map.spawns(), as (gid, x, y) unsigned 32-bit numbers
+Every block after the metadata starts at a multiple of 8 bytes, so the layers
+can be used straight from a memory map of the file.
+
+A compiled map is only used if every source file has the same size and mtime
+as when it was compiled, or failing that, the same hash."""
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+import gamelogic
+import mapformat
+
+MAGIC = 'LKMC'
+VERSION = 2
+
+header_format = struct.Struct('<4sHI')  # magic, version, length of metadata
+
+def compiled_name(filename):
+    return filename + 'c'
+
+def file_hash(filename):
+    result = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            result.update(data)
+    finally:
+        f.close()
+    return result.hexdigest()
+
+def describe_source(filename):
+    st = os.stat(filename)
+    return {'name': filename, 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': file_hash(filename)}
+
+def source_unchanged(source):
+    try:
+        st = os.stat(source['name'])
+    except OSError:
+        return False
+    if st.st_size != source['size']:
+        return False
+    return st.st_mtime == source['mtime'] or file_hash(source['name']) == source['sha1']
+
+def encode_value(value):
+    if isinstance(value, type):
+        if getattr(gamelogic, value.__name__, None) is not value:
+            raise ValueError("can't compile a reference to %r" % value)
+        return {'class': value.__name__}
+    elif value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    raise ValueError("can't compile tile property %r" % (value,))
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return getattr(gamelogic, value['class'])
+    elif isinstance(value, unicode):
+        return str(value)
+    return value
+
+def pad(f):
+    f.write('\0' * (-f.tell() % 8))
+
+def compile(tilemap, filename=None):
+    "Writes the compiled form of a mapformat.Map, by default next to its source"
+    if filename is None:
+        filename = compiled_name(tilemap.filename)
+
+    meta = {
+        'width': tilemap.width,
+        'height': tilemap.height,
+        'tilewidth': tilemap.tilewidth,
+        'tileheight': tilemap.tileheight,
+        'sources': [describe_source(name) for name in tilemap.sources()],
+        'layers': [],
+        'tilesets': [],
+        }
+    for firstgid, tileset in sorted(tilemap.tilesets.items()):
+        meta['tilesets'].append({
+            'firstgid': firstgid,
+            'tilewidth': tileset.width,
+            'tileheight': tileset.height,
+            'source': tileset.source,
+            'tiles': dict((str(index), dict((key, encode_value(value)) for key, value in info.iteritems()))
+                          for index, info in tileset.tiles.iteritems()),
+            })
+
+    spawns = array.array(mapformat.TILE_TYPECODE)
+    for spawn in tilemap.spawns():
+        spawns.extend(spawn)
+
+    blocks = [layer.tiles for layer in tilemap.layers]
+    blocks.append(spawns)
+
+    # the offsets go in the metadata, which comes before the blocks, so work
+    # out the metadata length first with placeholder offsets of the right size
+    for layer in tilemap.layers:
+        meta['layers'].append({'name': layer.name, 'width': layer.width, 'height': layer.height})
+    meta['spawns'] = len(tilemap.spawns())
+
+    offsets = [0] * len(blocks)
+    while True:
+        meta['offsets'] = offsets
+        data = json.dumps(meta, sort_keys=True)
+        pos = header_format.size + len(data)
+        new_offsets = []
+        for block in blocks:
+            pos += -pos % 8
+            new_offsets.append(pos)
+            pos += len(block) * block.itemsize
+        if new_offsets == offsets:
+            break
+        offsets = new_offsets
+
+    tmpname = filename + '.tmp'
+    f = open(tmpname, 'wb')
+    try:
+        f.write(header_format.pack(MAGIC, VERSION, len(data)))
+        f.write(data)
+        for block in blocks:
+            pad(f)
+            if sys.byteorder == 'big':
+                block = array.array(block.typecode, block)
+                block.byteswap()
+            block.tofile(f)
+    finally:
+        f.close()
+
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpname, filename)
+
+def read_array(mm, offset, count):
+    result = array.array(mapformat.TILE_TYPECODE)
+    result.fromstring(mm[offset:offset + count * result.itemsize])
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result
+
+class CompiledMap(object):
+    """A compiled map file kept open, so that parts of its layers can be read as
+    they are needed instead of decoding all of them up front.
+
+    tilemap is a mapformat.Map with the tilesets and spawn list but no layers.
+    The methods that a world.World needs are passed through to it."""
+
+    def __init__(self, f, mm, meta):
+        self.file = f
+        self.mm = mm
+        self.meta = meta
+
+        tilemap = self.tilemap = mapformat.Map(meta['width'], meta['height'], meta['tilewidth'], meta['tileheight'])
+        tilemap.filename = str(meta['sources'][0]['name'])
+        offsets = iter(meta['offsets'])
+
+        self.layer_offsets = [next(offsets) for info in meta['layers']]
+
+        spawns = read_array(mm, next(offsets), meta['spawns'] * 3)
+        tilemap.spawn_list = [tuple(int(value) for value in spawns[i:i+3]) for i in xrange(0, len(spawns), 3)]
+
+        for info in meta['tilesets']:
+            source = str(info['source'])
+            image = mapformat.load_tileset_image(source)
+            tileset = mapformat.TileSet(info['tilewidth'], info['tileheight'], image)
+            tileset.source = source
+            for index, values in info['tiles'].iteritems():
+                tileset.tiles[int(index)] = dict((str(key), decode_value(value)) for key, value in values.iteritems())
+            tilemap.tilesets[info['firstgid']] = tileset
+
+        self.width = tilemap.width
+        self.height = tilemap.height
+        self.tilewidth = tilemap.tilewidth
+        self.tileheight = tilemap.tileheight
+
+    def factories(self):
+        return self.tilemap.factories()
+
+    def spawns(self):
+        return self.tilemap.spawns()
+
+    def wall_gids(self):
+        return self.tilemap.wall_gids()
+
+    def tile_images(self, tilewidth=None, tileheight=None):
+        return self.tilemap.tile_images(tilewidth, tileheight)
+
+    def background_images(self, tilewidth=None, tileheight=None):
+        return self.tilemap.background_images(tilewidth, tileheight)
+
+    def layer_names(self):
+        return [str(info['name']) for info in self.meta['layers']]
+
+    def read_layer(self, index):
+        "Returns a mapformat.TileLayer with all of the index'th layer"
+        info = self.meta['layers'][index]
+        layer = mapformat.TileLayer(str(info['name']), info['width'], info['height'])
+        layer.tiles = read_array(self.mm, self.layer_offsets[index], layer.width * layer.height)
+        return layer
+
+    def read_region(self, index, x, y, width, height):
+        """Returns the tile ids of a rectangle of the index'th layer, row by row,
+        as an array, reading only those rows from the file"""
+        itemsize = array.array(mapformat.TILE_TYPECODE).itemsize
+        layer_width = self.meta['layers'][index]['width']
+        offset = self.layer_offsets[index]
+        mm = self.mm
+        result = array.array(mapformat.TILE_TYPECODE)
+        for row in range(y, y + height):
+            start = offset + (row * layer_width + x) * itemsize
+            result.fromstring(mm[start:start + width * itemsize])
+        if sys.byteorder == 'big':
+            result.byteswap()
+        return result
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+def blocks_fit(meta, size):
+    "Returns whether the layers and spawn list in meta lie inside a file of size bytes"
+    itemsize = array.array(mapformat.TILE_TYPECODE).itemsize
+    counts = [info['width'] * info['height'] for info in meta['layers']]
+    counts.append(meta['spawns'] * 3)
+    if len(meta['offsets']) != len(counts):
+        return False
+    for offset, count in zip(meta['offsets'], counts):
+        if offset < header_format.size or count < 0 or offset + count * itemsize > size:
+            return False
+    return True
+
+def open_compiled(filename):
+    """Returns a CompiledMap for filename, or None if it is missing, damaged,
+    from an older version of this module, or out of date with its sources"""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        f.close()
+        return None
+
+    try:
+        magic, version, meta_length = header_format.unpack_from(mm, 0)
+        if magic == MAGIC and version == VERSION:
+            meta = json.loads(mm[header_format.size:header_format.size + meta_length])
+            if not blocks_fit(meta, len(mm)):
+                return None
+            for source in meta['sources']:
+                if not source_unchanged(source):
+                    break
+            else:
+                result = CompiledMap(f, mm, meta)
+                f = mm = None
+                return result
+        return None
+    except (struct.error, ValueError, KeyError, TypeError):
+        # cut short or otherwise damaged; the TMX file will be parsed instead
+        return None
+    finally:
+        if mm is not None:
+            mm.close()
+        if f is not None:
+            f.close()
+
+def read(filename):
+    """Returns the Map compiled to filename, or None if it is missing, damaged,
+    from an older version of this module, or out of date with its sources"""
+    compiled = open_compiled(filename)
+    if compiled is None:
+        return None
+
+    try:
+        tilemap = compiled.tilemap
+        for index in range(len(compiled.meta['layers'])):
+            tilemap.layers.append(compiled.read_layer(index))
+        return tilemap
+    finally:
+        compiled.close()
+
+def load(filename):
+    """Returns the Map in a TMX file, from its compiled form if that is up to
+    date, otherwise parsing it and compiling it for next time"""
+    filename = os.path.abspath(filename)
+
+    tilemap = read(compiled_name(filename))
+    if tilemap is not None:
+        return tilemap
+
+    tilemap = mapformat.load(filename)
+    try:
+        compile(tilemap)
+    except (IOError, OSError, ValueError):
+        # a read-only directory or an unusual tile property; just parse next time
+        pass
+    return tilemap
+
+def open_map(filename):
+    """Returns a CompiledMap for a TMX file, compiling it first if needed. If it
+    can't be compiled, returns the parsed mapformat.Map instead, which has the
+    same methods."""
+    filename = os.path.abspath(filename)
+
+    compiled = open_compiled(compiled_name(filename))
+    if compiled is not None:
+        return compiled
+
+    tilemap = mapformat.load(filename)
+    try:
+        compile(tilemap)
+    except (IOError, OSError, ValueError):
+        return tilemap
+    return open_compiled(compiled_name(filename)) or tilemap
+
+def main(argv):
+    for filename in argv:
+        tilemap = mapformat.load(filename)
+        compile(tilemap)
+        print "compiled %s" % compiled_name(os.path.abspath(filename))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -21,10 +21,17 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import array
+import ast
+import base64
+import functools
+import inspect
 import os
+import re
 import sys
 import xml.sax
 import xml.sax.handler
+import zlib
 
 import pygame
 
@@ -42,18 +49,132 @@ def parse_range(string):
         else:
             yield int(item)
 
+NAME_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9_]*$')
+
+def parse_value(value):
+    """Reads a value from a tileset .ini file: a Python literal, or the name of
+    a class or constant in gamelogic"""
+    value = value.strip()
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    if NAME_PATTERN.match(value):
+        result = getattr(gamelogic, value, None)
+        if isinstance(result, (type, int, long, float, basestring)):
+            return result
+    raise ValueError("invalid tile property value %r" % value)
+
+# tile properties for the editor or the renderer rather than the object
+DISPLAY_PROPERTIES = frozenset(['type', 'usegraphic'])
+
+def tile_factory(info):
+    """Returns a callable taking (x, y, width, height) that makes the Moveable a
+    tile stands for, with the tile's other properties bound as keyword
+    arguments, or None if the tile isn't an object. Raises ValueError if the
+    properties don't fit the object's constructor."""
+    obj_type = info.get('type')
+    if not isinstance(obj_type, type) or issubclass(obj_type, gamelogic.Tile):
+        return None
+    if not issubclass(obj_type, gamelogic.Moveable):
+        raise ValueError("%s can't be placed with tiles" % obj_type.__name__)
+
+    argspec = inspect.getargspec(obj_type.__init__)
+    if argspec.args[1:5] != ['x', 'y', 'width', 'height']:
+        raise ValueError("%s can't be placed with tiles: it isn't made from (x, y, width, height)" % obj_type.__name__)
+    args = argspec.args[5:]
+    kwargs = dict((key, value) for key, value in info.iteritems() if key not in DISPLAY_PROPERTIES)
+    if not argspec.keywords:
+        unknown = sorted(key for key in kwargs if key not in args)
+        if unknown:
+            raise ValueError("%s tiles can't have %s" % (obj_type.__name__, ', '.join(unknown)))
+    missing = [name for name in args[:len(args) - len(argspec.defaults or ())] if name not in kwargs]
+    if missing:
+        raise ValueError("%s tiles need %s" % (obj_type.__name__, ', '.join(missing)))
+    return functools.partial(obj_type, **kwargs)
+
+# (filename, mtime) -> image, so that maps sharing a tileset load it once
+tileset_images = {}
+
+def load_tileset_image(source):
+    key = (source, os.stat(source).st_mtime)
+    try:
+        return tileset_images[key]
+    except KeyError:
+        pass
+    image = tileset_images[key] = pygame.image.load(source)
+    return image
+
 class TileSet(object):
     def __init__(self, tilewidth, tileheight, image):
         self.width = tilewidth
         self.height = tileheight
         self.image = image
         self.tiles = {}
+        self.source = None
+        self.converted = False
+        self.atlases = {}       # (tilewidth, tileheight) -> (image, rects)
+
+    def columns(self):
+        return self.image.get_width() / self.width
+
+    def rows(self):
+        return self.image.get_height() / self.height
+
+    def tile_rects(self, tilewidth, tileheight):
+        """Returns a list indexed by tile number of where each tile is in an
+        image of the tileset with tiles tilewidth by tileheight"""
+        columns = self.columns()
+        return [pygame.Rect((i % columns) * tilewidth, (i / columns) * tileheight, tilewidth, tileheight)
+                for i in range(columns * self.rows())]
+
+    def convert(self):
+        """Converts the image to the display's pixel format, keeping its alpha
+        channel if it has one. Does nothing until a display mode is set."""
+        if self.converted or pygame.display.get_surface() is None:
+            return
+        if self.image.get_flags() & pygame.SRCALPHA:
+            self.image = self.image.convert_alpha()
+        else:
+            self.image = self.image.convert()
+        self.converted = True
+        self.atlases.clear()
+
+    def atlas(self, tilewidth=None, tileheight=None):
+        """Returns an image of the tileset scaled so each tile is tilewidth by
+        tileheight, by default their own size, and the result of tile_rects()
+        for it. Scaled images are kept, so this is cheap after the first call
+        for each size."""
+        if tilewidth is None:
+            tilewidth = self.width
+        if tileheight is None:
+            tileheight = self.height
+        self.convert()
+
+        key = (tilewidth, tileheight)
+        try:
+            return self.atlases[key]
+        except KeyError:
+            pass
+
+        # leave out any partial tiles at the right and bottom edges, so each
+        # tile scales to exactly the requested size
+        columns = self.columns()
+        rows = self.rows()
+        image = self.image
+        if (image.get_width(), image.get_height()) != (columns * self.width, rows * self.height):
+            image = image.subsurface(pygame.Rect(0, 0, columns * self.width, rows * self.height))
+        if key != (self.width, self.height):
+            image = pygame.transform.scale(image, (columns * tilewidth, rows * tileheight))
+
+        result = self.atlases[key] = (image, self.tile_rects(tilewidth, tileheight))
+        return result
 
     def read_tile_info(self, filename):
         for section_name, section in iniformat.read(filename):
             real_values = {}
             for key, value in section.iteritems():
-                real_values[key] = eval(value, gamelogic.__dict__)
+                real_values[key] = parse_value(value)
             for index in parse_range(section_name):
                 if index not in self.tiles:
                     self.tiles[index] = {}
@@ -61,24 +182,261 @@ class TileSet(object):
 
     @staticmethod
     def from_source(source, tilewidth, tileheight):
-        image = pygame.image.load(source)
+        image = load_tileset_image(source)
         result = TileSet(tilewidth, tileheight, image)
+        result.source = source
         result.read_tile_info(source+'.ini')
         if DEBUG:
             print "tile info for %s: %s" % (source, repr(result.tiles))
         return result
 
+# array type code for unsigned 32-bit numbers
+if array.array('I').itemsize == 4:
+    TILE_TYPECODE = 'I'
+else:
+    TILE_TYPECODE = 'L'
+
+class TileLayer(object):
+    "A grid of global tile ids, stored row by row, with 0 meaning no tile"
+
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.tiles = array.array(TILE_TYPECODE)
+
+    def tile(self, x, y):
+        return self.tiles[y * self.width + x]
+
+class Base64Decoder(object):
+    """Turns the text of a base64 encoded <data> element into tile ids as it
+    arrives, appending them to a TileLayer"""
+
+    def __init__(self, layer, compression):
+        self.layer = layer
+        self.text = ''          # base64 characters left over from the last chunk
+        self.data = ''          # bytes left over that don't make up a whole tile
+        if not compression:
+            self.decompressor = None
+        elif compression == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif compression == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        else:
+            raise ValueError("unsupported layer compression %s" % compression)
+
+    def feed(self, text):
+        text = self.text + ''.join(text.encode('ascii').split())
+        end = len(text) - len(text) % 4
+        self.text = text[end:]
+        if end:
+            data = base64.b64decode(text[:end])
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            self.add_data(data)
+
+    def add_data(self, data):
+        if self.data:
+            data = self.data + data
+        end = len(data) - len(data) % 4
+        self.data = data[end:]
+        self.layer.tiles.fromstring(data[:end])
+
+    def close(self):
+        if self.text:
+            raise ValueError("layer %s: base64 data ends part way through" % self.layer.name)
+        if self.decompressor is not None:
+            self.add_data(self.decompressor.flush())
+        if self.data:
+            raise ValueError("layer %s: data ends part way through a tile" % self.layer.name)
+        # tiles are stored little-endian
+        if sys.byteorder == 'big':
+            self.layer.tiles.byteswap()
+
+class CSVDecoder(object):
+    "Turns the text of a csv encoded <data> element into tile ids as it arrives"
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.text = ''          # the start of a number cut off at the end of the last chunk
+
+    def feed(self, text):
+        numbers = (self.text + text.encode('ascii')).split(',')
+        self.text = numbers.pop()
+        self.layer.tiles.extend(int(x) for x in numbers)
+
+    def close(self):
+        if self.text.strip():
+            self.layer.tiles.append(int(self.text))
+
+class Map(object):
+    def __init__(self, width, height, tilewidth, tileheight):
+        self.width = width
+        self.height = height
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.filename = None
+        self.tilesets = {}      # first gid -> TileSet
+        self.layers = []        # TileLayers in the order they are drawn
+        self.spawn_list = None
+        self.factory_table = None
+        self.image_tables = {}  # (tilewidth, tileheight) -> list from tile_images(),
+                                # and ('background', tilewidth, tileheight) -> background_images()
+
+    def sources(self):
+        "Returns the names of the files this map was read from"
+        result = [self.filename]
+        for firstgid, tileset in sorted(self.tilesets.items()):
+            result.append(tileset.source)
+            result.append(tileset.source + '.ini')
+        return result
+
+    def factories(self):
+        """Returns a list indexed by global tile id of the tile_factory() for
+        each tile, None for tiles that aren't objects"""
+        if self.factory_table is None:
+            table = []
+            for firstgid, tileset in sorted(self.tilesets.items()):
+                for index, info in tileset.tiles.iteritems():
+                    factory = tile_factory(info)
+                    if factory is not None:
+                        gid = firstgid + index
+                        if gid >= len(table):
+                            table.extend([None] * (gid + 1 - len(table)))
+                        table[gid] = factory
+            self.factory_table = table
+        return self.factory_table
+
+    def tile_images(self, tilewidth=None, tileheight=None):
+        """Returns a list indexed by global tile id of (image, rect) for drawing
+        each tile tilewidth by tileheight, None for ids with no tile"""
+        for tileset in self.tilesets.itervalues():
+            if not tileset.converted:
+                tileset.convert()
+                if tileset.converted:
+                    self.image_tables.clear()
+
+        key = (tilewidth, tileheight)
+        try:
+            return self.image_tables[key]
+        except KeyError:
+            pass
+        table = [None]
+        for firstgid, tileset in sorted(self.tilesets.items()):
+            image, rects = tileset.atlas(tilewidth, tileheight)
+            end = firstgid + len(rects)
+            if end > len(table):
+                table.extend([None] * (end - len(table)))
+            for index, rect in enumerate(rects):
+                table[firstgid + index] = (image, rect)
+        self.image_tables[key] = table
+        return table
+
+    def background_images(self, tilewidth=None, tileheight=None):
+        """Returns tile_images(), but with None for tiles that stand for objects,
+        which draw themselves wherever they are rather than where they started"""
+        images = self.tile_images(tilewidth, tileheight)
+        key = ('background', tilewidth, tileheight)
+        try:
+            return self.image_tables[key]
+        except KeyError:
+            pass
+        table = list(images)
+        for gid, factory in enumerate(self.factories()[:len(table)]):
+            if factory is not None:
+                table[gid] = None
+        self.image_tables[key] = table
+        return table
+
+    def spawns(self):
+        """Returns (gid, x, y) for each tile that stands for an object rather
+        than a kind of Tile, with x and y in pixels"""
+        if self.spawn_list is None:
+            factories = self.factories()
+            self.spawn_list = []
+            for layer in self.layers:
+                spawn_gids = set(gid for gid in set(layer.tiles) if gid < len(factories) and factories[gid])
+                if not spawn_gids:
+                    continue
+                for i, gid in enumerate(layer.tiles):
+                    if gid in spawn_gids:
+                        self.spawn_list.append((gid, (i % layer.width) * self.tilewidth, (i / layer.width) * self.tileheight))
+        return self.spawn_list
+
+    def layer(self, name):
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        raise KeyError(name)
+
+    def layer_names(self):
+        return [layer.name for layer in self.layers]
+
+    def read_region(self, index, x, y, width, height):
+        """Returns the tile ids of a rectangle of the index'th layer, row by row,
+        as an array"""
+        tiles = self.layers[index].tiles
+        result = array.array(TILE_TYPECODE)
+        for row in range(y, y + height):
+            start = row * self.width + x
+            result.extend(tiles[start:start + width])
+        return result
+
+    def tile_info(self, gid):
+        "Returns the properties from the tileset .ini file for a global tile id"
+        firstgid = max([i for i in self.tilesets if i <= gid] or [None])
+        if firstgid is None:
+            return {}
+        return self.tilesets[firstgid].tiles.get(gid - firstgid, {})
+
+    def wall_gids(self):
+        "Returns the set of global tile ids that are Walls"
+        result = set()
+        for firstgid, tileset in self.tilesets.iteritems():
+            for index, info in tileset.tiles.iteritems():
+                if info.get('type') is gamelogic.Wall:
+                    result.add(firstgid + index)
+        return result
+
+    def solid_tiles(self):
+        "Returns a bytearray with 1 for each tile position where a layer has a Wall"
+        solid = bytearray(self.width * self.height)
+        wall_gids = self.wall_gids()
+
+        if wall_gids:
+            for layer in self.layers:
+                for i, gid in enumerate(layer.tiles):
+                    if gid in wall_gids:
+                        solid[i] = 1
+        return solid
+
+    def setup(self, state):
+        "Sizes state to fit this map and gives it the map's walls"
+        state.set_tiles(self.width, self.height, self.tilewidth, self.tileheight, self.solid_tiles())
+        state.tilemap = self
+
+    def populate(self, state):
+        "Adds the objects that the map's tiles stand for to state"
+        factories = self.factories()
+        width = self.tilewidth
+        height = self.tileheight
+        add = state.add
+        for gid, x, y in self.spawns():
+            add(factories[gid](x, y, width, height))
+
 class MapContentHandler(xml.sax.handler.ContentHandler):
     def startDocument(self):
-        self.tilesets = {}
-        self.layers = {}
+        self.map = None
         self.mapattrs = {}
         self.intileset = False
-        self.inlayer = False
+        self.layer = None
+        self.decoder = None
 
     def startElement(self, name, attrs):
         if name == 'map':
             self.mapattrs = attrs
+            self.map = Map(int(attrs['width']), int(attrs['height']),
+                           int(attrs['tilewidth']), int(attrs['tileheight']))
             if DEBUG:
                 print "start of map"
         elif name == 'tileset':
@@ -86,16 +444,44 @@ class MapContentHandler(xml.sax.handler.ContentHandler):
             self.tilesetattrs = attrs
         elif name == 'image' and self.intileset:
             self.tilesetimage = attrs['source']
+        elif name == 'layer':
+            self.layer = TileLayer(attrs['name'], int(attrs['width']), int(attrs['height']))
+        elif name == 'data' and self.layer is not None:
+            encoding = attrs.get('encoding')
+            if encoding == 'base64':
+                self.decoder = Base64Decoder(self.layer, attrs.get('compression'))
+            elif encoding == 'csv':
+                self.decoder = CSVDecoder(self.layer)
+            else:
+                raise ValueError("layer %s: unsupported encoding %s" % (self.layer.name, encoding))
+
+    def characters(self, content):
+        if self.decoder is not None:
+            self.decoder.feed(content)
 
     def endElement(self, name):
         if name == 'tileset' and self.intileset:
+            self.intileset = False
             source = os.path.normpath(os.path.join(os.path.dirname(self.filename), self.tilesetimage))
             if DEBUG:
                 print "found tileset: source=%s" % source
-            self.tilesets[self.tilesetattrs['firstgid']] = TileSet.from_source(
-                source, self.tilesetattrs['tilewidth'], self.tilesetattrs['tileheight'])
+            self.map.tilesets[int(self.tilesetattrs['firstgid'])] = TileSet.from_source(
+                source, int(self.tilesetattrs['tilewidth']), int(self.tilesetattrs['tileheight']))
+        elif name == 'data' and self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+        elif name == 'layer' and self.layer is not None:
+            layer = self.layer
+            self.layer = None
+            if len(layer.tiles) != layer.width * layer.height:
+                raise ValueError("layer %s: expected %d tiles, found %d" % (
+                    layer.name, layer.width * layer.height, len(layer.tiles)))
+            if DEBUG:
+                print "found layer: name=%s, %dx%d" % (layer.name, layer.width, layer.height)
+            self.map.layers.append(layer)
 
 def load(filename):
+    "Reads a Tiled map file, returning a Map"
     filename = os.path.abspath(filename)
 
     xmlhandler = MapContentHandler()
@@ -103,6 +489,11 @@ def load(filename):
 
     xml.sax.parse(filename, xmlhandler)
 
+    xmlhandler.map.filename = filename
+    # tiles whose objects can't be made fail here rather than when they spawn
+    xmlhandler.map.factories()
+    return xmlhandler.map
+
 def main(argv):
     global DEBUG
     DEBUG = True
@@ -0,0 +1,153 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+
+"""Stepping large numbers of Balls at once with NumPy.
+
+At the start of each frame, Batch.prepare gathers the awake Balls that will
+just fly straight, and works out their moves together: the trig, the split
+into whole pixels and sub-pixel error that Moveable.move does, and whether
+the area they pass through touches a screen edge or a wall tile. When each
+ball's turn comes, if nothing has changed it and nothing but other balls is in
+its way, it is put at the end of its move directly. Otherwise it moves with its
+own advance(), as it would without a Batch. Either way the game comes out
+the same.
+
+NumPy is optional. Without it a Batch does nothing."""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import gamelogic
+
+# Balls that move as Ball.advance does whenever straight_line() is true.
+# Subclasses aren't included, since they may behave differently.
+BALL_TYPES = frozenset((gamelogic.Ball, gamelogic.FairyBall, gamelogic.Boomerang))
+
+def float_divmod(a):
+    """Does what divmod(x, 1.0) does for each x in a, with the same rounding,
+    returning the quotients as integers"""
+    mod = numpy.fmod(a, 1.0)
+    div = a - mod
+    negative = mod < 0
+    mod[negative] += 1.0
+    div[negative] -= 1.0
+    mod[mod == 0] = 0.0         # no negative zeros
+    floordiv = numpy.floor(div)
+    floordiv[div - floordiv > 0.5] += 1.0
+    return floordiv.astype(numpy.int64), mod
+
+class Batch(object):
+    """Set as State.projectiles to step Balls in bulk.
+
+    Frames with fewer than min_balls straight-flying Balls are left to the
+    Balls themselves, since gathering them costs more than it saves."""
+
+    def __init__(self, min_balls=32):
+        self.min_balls = min_balls
+        self.plans = {}         # ball -> what step() needs to know
+        self.walls_key = None
+        self.walls = None       # running totals of State.solid, for counting walls in a box
+
+    def wall_sums(self, state):
+        "Returns a table where [ty, tx] is the number of walls above and left of tile (tx, ty)"
+        key = (state.tiles_version, state.xtiles, state.ytiles)
+        if key != self.walls_key:
+            solid = numpy.frombuffer(bytes(state.solid), numpy.uint8).reshape(state.ytiles, state.xtiles)
+            self.walls = numpy.zeros((state.ytiles + 1, state.xtiles + 1), numpy.int64)
+            self.walls[1:, 1:] = solid.cumsum(0).cumsum(1)
+            self.walls_key = key
+        return self.walls
+
+    def prepare(self, state, inputs, objects):
+        "Plans the moves of the Balls among objects for this frame"
+        self.plans = {}
+        if numpy is None:
+            return
+
+        balls = [obj for obj in objects
+                 if type(obj) in BALL_TYPES and not obj.sleeping and not obj.solid and obj.straight_line(inputs)]
+        if len(balls) < self.min_balls:
+            return
+
+        positions = numpy.array([(obj.x, obj.y, obj.width, obj.height) for obj in balls], numpy.int64)
+        motion = numpy.array([(obj.angle, obj.speed, obj.xerror, obj.yerror) for obj in balls], numpy.float64)
+        x, y, width, height = positions.T
+        angle, speed, xerror, yerror = motion.T
+
+        # as in Ball.advance and Moveable.move
+        dx, new_xerror = float_divmod(speed * numpy.cos(angle) + xerror)
+        dy, new_yerror = float_divmod(speed * numpy.sin(angle) + yerror)
+        new_x = x + dx
+        new_y = y + dy
+
+        # every pixel that can be tested on the way; like sweep(), this takes in
+        # the column and row past the far edges, which move_right and
+        # move_down test too
+        left = numpy.minimum(x, new_x)
+        top = numpy.minimum(y, new_y)
+        right = numpy.maximum(x, new_x) + width
+        bottom = numpy.maximum(y, new_y) + height
+
+        clear = (left >= 0) & (top >= 0) & (right < state.width) & (bottom < state.height)
+        if state.solid:
+            walls = self.wall_sums(state)
+            tx0 = numpy.clip(left // state.tilewidth, 0, state.xtiles)
+            ty0 = numpy.clip(top // state.tileheight, 0, state.ytiles)
+            tx1 = numpy.clip(right // state.tilewidth + 1, 0, state.xtiles)
+            ty1 = numpy.clip(bottom // state.tileheight + 1, 0, state.ytiles)
+            clear &= (walls[ty1, tx1] - walls[ty0, tx1] - walls[ty1, tx0] + walls[ty0, tx0]) == 0
+        # balls that don't move a whole pixel touch nothing
+        clear |= (dx == 0) & (dy == 0)
+
+        columns = [a.tolist() for a in (x, y, angle, speed, xerror, yerror, new_x, new_y,
+                                        new_xerror, new_yerror, left, top, right, bottom)]
+        plans = self.plans
+        for i in numpy.flatnonzero(clear).tolist():
+            plans[balls[i]] = tuple(column[i] for column in columns)
+
+    def step(self, state, obj, inputs):
+        """Moves obj as planned and returns True, or returns False if it has to
+        advance() itself because something changed or is in its way"""
+        plan = self.plans.pop(obj, None)
+        if plan is None:
+            return False
+        x, y, angle, speed, xerror, yerror, new_x, new_y, new_xerror, new_yerror, left, top, right, bottom = plan
+
+        if obj.x != x or obj.y != y or obj.angle != angle or obj.speed != speed or \
+           obj.xerror != xerror or obj.yerror != yerror or not obj.straight_line(inputs):
+            return False
+
+        if new_x != x or new_y != y:
+            for other in state.grid.query(left, top, right, bottom):
+                if other is not obj and \
+                   other.x <= right and left < other.x + other.width and \
+                   other.y <= bottom and top < other.y + other.height and \
+                   gamelogic.collision_pairs[type(obj), type(other)] is not None:
+                    return False
+            obj.x = new_x
+            obj.y = new_y
+
+        obj.xerror = new_xerror
+        obj.yerror = new_yerror
+        return True
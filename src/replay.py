@@ -0,0 +1,139 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Recording of the inputs to a game, so that it can be played back exactly.
+
+A recording starts with a header giving the scenario and random seed the
+game was started with. After that come records, each starting with a byte:
+  'F': one frame of input: dx, dy and a bitmask of the mouse buttons held
+  'K': a keyframe: the frame number and a pickled State.snapshot() taken
+       before that frame, so that playback can start there
+All numbers are little-endian."""
+
+import cPickle
+import struct
+
+import gamelogic
+import scenarios
+
+MAGIC = 'LKRP'
+VERSION = 1
+
+header_format = struct.Struct('<4sHIB')  # magic, version, seed, length of scenario name
+frame_format = struct.Struct('<hhH')     # dx, dy, buttons
+keyframe_format = struct.Struct('<II')   # frame number, length of pickle
+
+FRAME = 'F'
+KEYFRAME = 'K'
+
+class Recorder(object):
+    "Writes the inputs to a game to a file"
+
+    def __init__(self, filename, scenario, seed, keyframe_interval=500):
+        self.file = open(filename, 'wb')
+        self.file.write(header_format.pack(MAGIC, VERSION, seed, len(scenario)))
+        self.file.write(scenario)
+        self.keyframe_interval = keyframe_interval
+        self.frame = 0
+
+    def record(self, state, inputs):
+        "Must be called with the inputs for each frame, before passing them to state.advance()"
+        if self.keyframe_interval and self.frame and self.frame % self.keyframe_interval == 0:
+            data = cPickle.dumps(state.snapshot(), cPickle.HIGHEST_PROTOCOL)
+            self.file.write(KEYFRAME)
+            self.file.write(keyframe_format.pack(self.frame, len(data)))
+            self.file.write(data)
+
+        buttons = 0
+        for button in inputs.buttons_pressed:
+            if 1 <= button <= 16:
+                buttons |= 1 << (button - 1)
+        self.file.write(FRAME)
+        self.file.write(frame_format.pack(inputs.dx, inputs.dy, buttons))
+        self.frame += 1
+
+    def close(self):
+        self.file.close()
+
+class Recording(object):
+    "The contents of a file written by Recorder"
+
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        magic, version, self.seed, name_length = header_format.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a recording" % filename)
+        if version != VERSION:
+            raise ValueError("%s is recording version %s, expected %s" % (filename, version, VERSION))
+        pos = header_format.size
+        self.scenario = data[pos:pos+name_length]
+        pos += name_length
+
+        self.frames = []
+        self.keyframes = {}     # frame number -> pickled snapshot
+        while pos < len(data):
+            kind = data[pos]
+            pos += 1
+            if kind == FRAME:
+                self.frames.append(frame_format.unpack_from(data, pos))
+                pos += frame_format.size
+            elif kind == KEYFRAME:
+                frame, length = keyframe_format.unpack_from(data, pos)
+                pos += keyframe_format.size
+                self.keyframes[frame] = data[pos:pos+length]
+                pos += length
+            else:
+                raise ValueError("%s: unknown record type %r at offset %d" % (filename, kind, pos-1))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def inputs(self, frame):
+        "Returns the Inputs for the given frame"
+        dx, dy, buttons = self.frames[frame]
+        inputs = gamelogic.Inputs()
+        inputs.dx = dx
+        inputs.dy = dy
+        inputs.buttons_pressed = frozenset(i + 1 for i in range(16) if buttons & (1 << i))
+        return inputs
+
+    def state_at(self, frame):
+        """Returns the State just before the given frame, starting from the
+        nearest keyframe. Frame may be len(self), for the State at the end."""
+        if not 0 <= frame <= len(self):
+            raise ValueError("frame %d is outside the recording, which has %d frames" % (frame, len(self)))
+        state = scenarios.build(self.scenario, self.seed)
+
+        start = max([i for i in self.keyframes if i <= frame] or [0])
+        if start:
+            state.restore(cPickle.loads(self.keyframes[start]))
+
+        for i in xrange(start, frame):
+            state.advance(self.inputs(i))
+
+        return state
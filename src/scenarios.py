@@ -0,0 +1,128 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"Named setups for a new gamelogic.State"
+
+import math
+import os
+
+import gamelogic
+
+# mapcache, world and projectiles are imported by the scenarios that use them,
+# since loading maps needs pygame, which headless runs shouldn't have to load
+
+MAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data', 'maps')
+
+def default(state, max_objects=0, escalation_time=750, min_distance_sq=12544, robot_speed=2):
+    "The game as started by main.py"
+    player = gamelogic.Plunger(128, 0, 16, 16, gamelogic.UP)
+    state.add(player)
+
+    #state.add(gamelogic.Ball(128, 0, 8, 8))
+    #state.add(gamelogic.Generator(gamelogic.Robot, 3, 16, 16, 12544, 2, False))
+    state.add(gamelogic.EscalatingGenerator(gamelogic.Robot, max_objects, escalation_time, 16, 16,
+                                            min_distance_sq, robot_speed, True))
+
+    for i in range(8, 26, 4):
+        state.add(gamelogic.DaggerBit(player, 3, 3, i))
+
+def robots(state, count=40):
+    "A harmless plunger chased by robots, up to count at a time"
+    state.add(gamelogic.Plunger(120, 112, 16, 16, gamelogic.UP))
+    state.add(gamelogic.EscalatingGenerator(gamelogic.Robot, 0, max(1, 2000 / count), 16, 16, 1024, 2, False))
+
+def balls(state, count=200):
+    "Balls bouncing around the screen at different speeds"
+    for i in range(count):
+        state.add(gamelogic.Ball(state.random.randint(0, state.width - 8),
+                                 state.random.randint(0, state.height - 8),
+                                 8, 8, state.random.uniform(0, math.pi * 2), state.random.randint(1, 6)))
+
+def swarm(state, count=2000):
+    "Thousands of balls moved by a projectiles.Batch, among a few walls"
+    import projectiles
+    state.projectiles = projectiles.Batch()
+    for x in range(32, state.width - 32, 64):
+        state.add(gamelogic.ForegroundWall(x, state.height / 2 - 8, 16, 16))
+    for i in range(count):
+        state.add(gamelogic.Ball(state.random.randint(0, state.width - 4),
+                                 state.random.randint(0, state.height - 4),
+                                 4, 4, state.random.uniform(0, math.pi * 2), state.random.randint(1, 6)))
+
+def fairies(state, count=60):
+    "FairyBalls, Boomerangs and Balls among walls, with a plunger and robots"
+    state.add(gamelogic.Plunger(120, 112, 16, 16, gamelogic.UP))
+    for x in range(16, state.width - 16, 48):
+        state.add(gamelogic.ForegroundWall(x, 64, 16, 16))
+        state.add(gamelogic.ForegroundWall(x + 16, 160, 16, 16))
+    for i in range(count):
+        cls = (gamelogic.FairyBall, gamelogic.Boomerang, gamelogic.Ball)[i % 3]
+        state.add(cls(state.random.randint(0, state.width - 6),
+                      state.random.randint(0, state.height - 6),
+                      6, 6, state.random.uniform(0, math.pi * 2), state.random.randint(1, 6)))
+    state.add(gamelogic.Generator(gamelogic.Robot, 6, 16, 16, 1024, 1, False))
+
+def walls(state):
+    "Balls and robots moving through a dense field of walls"
+    player = gamelogic.Plunger(120, 112, 16, 16, gamelogic.UP)
+    state.add(player)
+    for x in range(0, state.width, 32):
+        for y in range(0, state.height, 32):
+            if abs(x - player.x) >= 32 or abs(y - player.y) >= 32:
+                state.add(gamelogic.ForegroundWall(x + 8, y + 8, 16, 16))
+    for i in range(20):
+        state.add(gamelogic.Ball(4 + (i % 8) * 32, 4 + (i / 8) * 32, 4, 4, state.random.uniform(0, math.pi * 2), 3))
+    state.add(gamelogic.Generator(gamelogic.Robot, 10, 8, 8, 256, 1, False))
+
+def test_map(state):
+    "The objects and walls of data/maps/test.tmx"
+    import mapcache
+    tilemap = mapcache.load(os.path.join(MAP_DIR, 'test.tmx'))
+    tilemap.setup(state)
+    tilemap.populate(state)
+
+def test_world(state):
+    "data/maps/test.tmx as a scrolling world, with a small camera and small chunks"
+    import mapcache
+    import world
+    tilemap = mapcache.open_map(os.path.join(MAP_DIR, 'test.tmx'))
+    world.World(tilemap, chunk_xtiles=4, chunk_ytiles=4, view_xtiles=8, view_ytiles=8).setup(state)
+
+scenarios = {
+    'default': default,
+    'robots': robots,
+    'balls': balls,
+    'walls': walls,
+    'swarm': swarm,
+    'fairies': fairies,
+    'test_map': test_map,
+    'test_world': test_world,
+    }
+
+def build(name, seed=None, **params):
+    """Returns a new State set up by the named scenario, with its random number
+    generator seeded. Any params are passed to the scenario function."""
+    state = gamelogic.State()
+    state.random.seed(seed)
+    scenarios[name](state, **params)
+    return state
@@ -0,0 +1,145 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"Runs the game logic without a display, as fast as possible, and reports how long it took"
+
+import optparse
+import random
+import sys
+import timeit
+
+import gamelogic
+import scenarios
+
+def idle_inputs():
+    while True:
+        yield gamelogic.Inputs()
+
+def random_inputs(seed):
+    "Moves the mouse around at random, occasionally holding a button"
+    rand = random.Random(seed)
+    buttons_pressed = set()
+    while True:
+        inputs = gamelogic.Inputs()
+        inputs.dx = rand.randint(-6, 6)
+        inputs.dy = rand.randint(-6, 6)
+        for button in (1, 3):
+            if rand.random() < 0.05:
+                buttons_pressed.symmetric_difference_update((button,))
+        inputs.buttons_pressed = frozenset(buttons_pressed)
+        yield inputs
+
+def scripted_inputs(lines):
+    """Reads one frame of input per line: dx, dy, then any buttons held, separated
+    by whitespace. Blank lines and anything after # are skipped. Once the script
+    runs out, there is no more input."""
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        inputs = gamelogic.Inputs()
+        inputs.dx = int(fields[0])
+        inputs.dy = int(fields[1])
+        inputs.buttons_pressed = frozenset(int(x) for x in fields[2:])
+        yield inputs
+
+    for inputs in idle_inputs():
+        yield inputs
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+class Report(object):
+    "Timings and object counts from a run"
+
+    def __init__(self, frame_times, object_counts):
+        self.frame_times = frame_times
+        self.object_counts = object_counts
+
+    def total_time(self):
+        return sum(self.frame_times)
+
+    def frames_per_second(self):
+        return len(self.frame_times) / self.total_time()
+
+    def latency(self, fraction):
+        return percentile(sorted(self.frame_times), fraction)
+
+    def describe(self):
+        frame_times = sorted(self.frame_times)
+        counts = self.object_counts
+        return "\n".join((
+            "%d frames in %.3fs (%.1f frames/sec)" % (len(frame_times), self.total_time(), self.frames_per_second()),
+            "frame time: p50 %.3fms, p90 %.3fms, p99 %.3fms, max %.3fms" % tuple(
+                percentile(frame_times, f) * 1000 for f in (0.5, 0.9, 0.99, 1.0)),
+            "objects: final %d, peak %d, mean %.1f" % (counts[-1], max(counts), sum(counts) / float(len(counts))),
+            ))
+
+def run(state, inputs, frames):
+    "Advances state by the given number of frames, taking one Inputs per frame from inputs"
+    timer = timeit.default_timer
+    frame_times = []
+    object_counts = []
+
+    for i in xrange(frames):
+        frame_inputs = next(inputs)
+        start = timer()
+        state.advance(frame_inputs)
+        frame_times.append(timer() - start)
+        object_counts.append(len(state.objects))
+
+    return Report(frame_times, object_counts)
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--scenario', default='default',
+        help="scenario to run, one of: %s" % ', '.join(sorted(scenarios.scenarios)))
+    parser.add_option('-n', '--frames', type='int', default=5000,
+        help="number of frames to simulate")
+    parser.add_option('--seed', type='int', default=0,
+        help="seed for the game and for random inputs")
+    parser.add_option('--script', metavar='FILE',
+        help="read inputs from FILE instead of generating them")
+    parser.add_option('--idle', action='store_true',
+        help="give no inputs at all")
+    options, args = parser.parse_args(argv)
+
+    if options.scenario not in scenarios.scenarios:
+        parser.error("unknown scenario %s" % options.scenario)
+
+    state = scenarios.build(options.scenario, options.seed)
+
+    if options.idle:
+        inputs = idle_inputs()
+    elif options.script:
+        inputs = scripted_inputs(open(options.script))
+    else:
+        inputs = random_inputs(options.seed)
+
+    report = run(state, inputs, options.frames)
+
+    print "scenario %s, seed %d" % (options.scenario, options.seed)
+    print report.describe()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,218 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+
+"""Runs many seeded games without a display across a pool of processes, with
+the plunger steered by a simple AI, to see how scenario parameters change the
+game's difficulty.
+
+Each parameter is given as NAME=VALUE,VALUE,... and every combination is run
+with each seed. The parameters are passed to the scenario function, e.g.
+  sweep.py -p escalation_time=500,750,1000 -p robot_speed=1,2,3 --seeds 200"""
+
+import ast
+import itertools
+import multiprocessing
+import optparse
+import sys
+
+import gamelogic
+import scenarios
+
+AI_SPEED = 6    # most pixels the AI moves the plunger per frame, like the arrow keys
+
+def nearest(obj, others):
+    cx = obj.x + obj.width / 2
+    cy = obj.y + obj.height / 2
+    return min(others, key=lambda o: (o.x + o.width / 2 - cx) ** 2 + (o.y + o.height / 2 - cy) ** 2)
+
+def steer(dx, dy):
+    "Returns Inputs moving up to AI_SPEED pixels in the direction of (dx, dy)"
+    inputs = gamelogic.Inputs()
+    distance = max(abs(dx), abs(dy))
+    if distance:
+        scale = min(AI_SPEED, distance) / float(distance)
+        inputs.dx = int(round(dx * scale))
+        inputs.dy = int(round(dy * scale))
+    return inputs
+
+def hunt(state):
+    "Heads straight for the nearest robot, so that it runs onto the daggers"
+    for player in state.instances(gamelogic.Plunger):
+        robots = state.instances(gamelogic.Robot)
+        if robots:
+            robot = nearest(player, robots)
+            return steer(robot.x - player.x, robot.y - player.y)
+    return gamelogic.Inputs()
+
+def flee(state):
+    "Runs from the nearest robot, drifting back to the middle of the screen"
+    for player in state.instances(gamelogic.Plunger):
+        dx = (state.width - player.width) / 2 - player.x
+        dy = (state.height - player.height) / 2 - player.y
+        robots = state.instances(gamelogic.Robot)
+        if robots:
+            robot = nearest(player, robots)
+            dx = dx / 4 + (player.x - robot.x) * 2
+            dy = dy / 4 + (player.y - robot.y) * 2
+        return steer(dx, dy)
+    return gamelogic.Inputs()
+
+ais = {
+    'hunt': hunt,
+    'flee': flee,
+    'idle': lambda state: gamelogic.Inputs(),
+    }
+
+def play(scenario, ai, frames, params, seed):
+    """Plays one game, returning (frames survived, robots killed, peak number
+    of objects). The game ends early when there are no plungers left."""
+    state = scenarios.build(scenario, seed, **params)
+    kills = 0
+    peak = len(state.objects)
+
+    for frame in xrange(frames):
+        if not state.count(gamelogic.Plunger):
+            return frame, kills, peak
+        robots = state.instances(gamelogic.Robot)
+        state.advance(ai(state))
+        for robot in robots:
+            if robot.dead:
+                kills += 1
+        peak = max(peak, len(state.objects))
+
+    return frames, kills, peak
+
+# set in each worker process by start_worker, so tasks only carry what differs
+job = None
+
+def start_worker(scenario, ai_name, frames):
+    global job
+    job = (scenario, ais[ai_name], frames)
+
+def run_task(task):
+    index, params, seed = task
+    scenario, ai, frames = job
+    return (index, seed) + play(scenario, ai, frames, params, seed)
+
+class Totals(object):
+    "Sums of the results for one combination of parameters"
+
+    def __init__(self, params):
+        self.params = params
+        self.runs = 0
+        self.survived = 0       # runs that lasted every frame
+        self.frames = 0
+        self.kills = 0
+        self.peak = 0
+        self.max_peak = 0
+
+    def add(self, frames, kills, peak, total_frames):
+        self.runs += 1
+        if frames == total_frames:
+            self.survived += 1
+        self.frames += frames
+        self.kills += kills
+        self.peak += peak
+        self.max_peak = max(self.max_peak, peak)
+
+    def describe(self):
+        runs = float(self.runs)
+        params = ' '.join('%s=%r' % item for item in sorted(self.params.items())) or '(defaults)'
+        return "%s: survived %d/%d, mean %.0f frames, %.1f kills, peak objects mean %.1f max %d" % (
+            params, self.survived, self.runs, self.frames / runs, self.kills / runs, self.peak / runs, self.max_peak)
+
+def parse_param(option, opt, value, parser):
+    try:
+        name, values = value.split('=', 1)
+        values = [ast.literal_eval(x) for x in values.split(',')]
+    except (ValueError, SyntaxError):
+        raise optparse.OptionValueError("%s: expected NAME=VALUE,VALUE,... but got %r" % (opt, value))
+    parser.values.params.append((name, values))
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--scenario', default='default',
+        help="scenario to run, one of: %s" % ', '.join(sorted(scenarios.scenarios)))
+    parser.add_option('-p', '--param', action='callback', callback=parse_param, type='string',
+        metavar='NAME=VALUES', help="values to try for a scenario parameter, separated by commas")
+    parser.add_option('-a', '--ai', default='hunt',
+        help="how to steer the plunger, one of: %s" % ', '.join(sorted(ais)))
+    parser.add_option('-n', '--frames', type='int', default=5000,
+        help="most frames to simulate per game")
+    parser.add_option('--seeds', type='int', default=100,
+        help="number of games to play for each combination of parameters")
+    parser.add_option('--first-seed', type='int', default=0)
+    parser.add_option('-j', '--processes', type='int', default=None,
+        help="number of worker processes, by default one per CPU")
+    parser.add_option('--csv', metavar='FILE',
+        help="write the result of every game to FILE")
+    parser.set_defaults(params=[])
+    options, args = parser.parse_args(argv)
+
+    if options.scenario not in scenarios.scenarios:
+        parser.error("unknown scenario %s" % options.scenario)
+    if options.ai not in ais:
+        parser.error("unknown AI %s" % options.ai)
+    if options.seeds < 1:
+        parser.error("--seeds must be at least 1")
+    if options.processes is not None and options.processes < 1:
+        parser.error("-j must be at least 1")
+
+    names = [name for name, values in options.params]
+    combinations = [dict(zip(names, values))
+                    for values in itertools.product(*[values for name, values in options.params])]
+    totals = [Totals(params) for params in combinations]
+    seeds = range(options.first_seed, options.first_seed + options.seeds)
+    tasks = [(index, params, seed) for index, params in enumerate(combinations) for seed in seeds]
+
+    csv = None
+    if options.csv:
+        csv = open(options.csv, 'w')
+        csv.write(','.join(names + ['seed', 'frames', 'kills', 'peak_objects']) + '\n')
+
+    processes = options.processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, start_worker, (options.scenario, options.ai, options.frames))
+    try:
+        # hand out tasks a few at a time, so results stream back as they finish
+        # and workers that get short games aren't left idle
+        chunksize = max(1, min(16, len(tasks) // (processes * 8)))
+        for index, seed, frames, kills, peak in pool.imap_unordered(run_task, tasks, chunksize):
+            totals[index].add(frames, kills, peak, options.frames)
+            if csv is not None:
+                values = [combinations[index][name] for name in names]
+                csv.write(','.join(str(x) for x in values + [seed, frames, kills, peak]) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if csv is not None:
+            csv.close()
+
+    print "scenario %s, %s AI, %d frames, seeds %d-%d" % (
+        options.scenario, options.ai, options.frames, seeds[0], seeds[-1])
+    for total in totals:
+        print total.describe()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,259 @@
+# Copyright (c) 2010 Vincent Povirk
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+
+"""Maps bigger than the screen.
+
+A World splits a map into chunks of tiles and keeps a camera over it. Only the
+chunks near the camera are active: their objects are in the State and advance
+every frame, while the objects of other chunks wait in their chunk, so a frame
+costs the same however big the map is. Chunks further away are evicted,
+dropping their tiles; the objects parked in them stay. Each chunk's objects are
+spawned from the map once, the first time it becomes active.
+
+The State covers the whole map, so positions mean the same thing everywhere
+and the edges of the map are the only screen edges. Its walls are filled in
+as chunks are loaded."""
+
+import gamelogic
+
+class Chunk(object):
+    "A rectangle of a World's tiles, and the objects parked in it while it is inactive"
+
+    def __init__(self, tx, ty, xtiles, ytiles):
+        self.tx = tx
+        self.ty = ty
+        self.xtiles = xtiles
+        self.ytiles = ytiles
+        self.tiles = None       # an array of tile ids for each layer, or None until loaded
+        self.objects = []
+
+class World(object):
+    """Decides which parts of a map are in play, moving the camera to follow the
+    first object of the target class.
+
+    tilemap is a mapcache.CompiledMap, which reads chunks of the layers from
+    disk as they are needed, or a mapformat.Map. Chunks up to active_margin
+    chunks away from the camera are active, and the tiles of chunks more than
+    keep_margin away are evicted."""
+
+    def __init__(self, tilemap, chunk_xtiles=16, chunk_ytiles=15, view_xtiles=16, view_ytiles=15,
+                 active_margin=1, keep_margin=3, target=gamelogic.Plunger):
+        self.tilemap = tilemap
+        self.chunk_xtiles = chunk_xtiles
+        self.chunk_ytiles = chunk_ytiles
+        self.xchunks = -(-tilemap.width // chunk_xtiles)
+        self.ychunks = -(-tilemap.height // chunk_ytiles)
+        self.active_margin = active_margin
+        self.keep_margin = max(keep_margin, active_margin)
+        self.target = target
+
+        self.chunks = {}            # (cx, cy) -> Chunk, for chunks in memory
+        self.active = set()         # keys of the active chunks
+        self.spawned = set()        # keys of chunks whose objects have been made from the map
+        self.solid_loaded = set()   # keys of chunks whose walls have been given to the State
+        self.wall_gids = tilemap.wall_gids()
+        self.layer_count = len(tilemap.layer_names())
+
+        self.camera = (0, 0, view_xtiles * tilemap.tilewidth, view_ytiles * tilemap.tileheight)
+
+        # the map's objects by chunk, and where to start the camera
+        factories = tilemap.factories()
+        self.spawns = {}
+        start = None
+        for gid, x, y in tilemap.spawns():
+            self.spawns.setdefault(self.chunk_at(x, y), []).append((gid, x, y))
+            if start is None and issubclass(factories[gid].func, target):
+                start = (x + tilemap.tilewidth / 2, y + tilemap.tileheight / 2)
+        if start is not None:
+            self.center_on(*start)
+
+    def setup(self, state):
+        "Sizes state to fit the map and puts the objects near the camera in play"
+        tilemap = self.tilemap
+        state.set_tiles(tilemap.width, tilemap.height, tilemap.tilewidth, tilemap.tileheight,
+                        bytearray(tilemap.width * tilemap.height))
+        state.world = self
+        self.update(state)
+
+    def chunk_at(self, x, y):
+        "Returns the key of the chunk containing the pixel (x, y)"
+        cx = int(x) // (self.chunk_xtiles * self.tilemap.tilewidth)
+        cy = int(y) // (self.chunk_ytiles * self.tilemap.tileheight)
+        return (max(0, min(cx, self.xchunks - 1)), max(0, min(cy, self.ychunks - 1)))
+
+    def chunk_range(self, margin):
+        "Returns the keys of the chunks up to margin chunks away from the camera"
+        left, top, width, height = self.camera
+        cx0, cy0 = self.chunk_at(left, top)
+        cx1, cy1 = self.chunk_at(left + width - 1, top + height - 1)
+        return set((cx, cy)
+                   for cy in range(max(cy0 - margin, 0), min(cy1 + margin, self.ychunks - 1) + 1)
+                   for cx in range(max(cx0 - margin, 0), min(cx1 + margin, self.xchunks - 1) + 1))
+
+    def chunk(self, key):
+        try:
+            return self.chunks[key]
+        except KeyError:
+            pass
+        cx, cy = key
+        tx = cx * self.chunk_xtiles
+        ty = cy * self.chunk_ytiles
+        result = self.chunks[key] = Chunk(tx, ty,
+            min(self.chunk_xtiles, self.tilemap.width - tx),
+            min(self.chunk_ytiles, self.tilemap.height - ty))
+        return result
+
+    def load(self, chunk):
+        "Reads the tiles of chunk, if they aren't already in memory"
+        if chunk.tiles is None:
+            chunk.tiles = [self.tilemap.read_region(i, chunk.tx, chunk.ty, chunk.xtiles, chunk.ytiles)
+                           for i in range(self.layer_count)]
+
+    def load_solid(self, state, key):
+        chunk = self.chunk(key)
+        self.load(chunk)
+        solid = bytearray(chunk.xtiles * chunk.ytiles)
+        wall_gids = self.wall_gids
+        for tiles in chunk.tiles:
+            if not wall_gids.intersection(tiles):
+                continue
+            for i, gid in enumerate(tiles):
+                if gid in wall_gids:
+                    solid[i] = 1
+        state.set_solid(chunk.tx, chunk.ty, chunk.xtiles, solid)
+        self.solid_loaded.add(key)
+
+    def center_on(self, x, y):
+        "Moves the camera to be centered on (x, y), as far as the edges of the map allow"
+        left, top, width, height = self.camera
+        left = max(0, min(int(x) - width / 2, self.tilemap.width * self.tilemap.tilewidth - width))
+        top = max(0, min(int(y) - height / 2, self.tilemap.height * self.tilemap.tileheight - height))
+        self.camera = (left, top, width, height)
+
+    def follow(self, state):
+        for obj in state.instances(self.target):
+            self.center_on(obj.x + obj.width / 2, obj.y + obj.height / 2)
+            break
+
+    def activate(self, state, key):
+        chunk = self.chunk(key)
+        objs = []
+        if key not in self.spawned:
+            factories = self.tilemap.factories()
+            width = self.tilemap.tilewidth
+            height = self.tilemap.tileheight
+            for gid, x, y in self.spawns.get(key, ()):
+                objs.append(factories[gid](x, y, width, height))
+            self.spawned.add(key)
+        objs.extend(chunk.objects)
+        chunk.objects = []
+        state.add_all(objs)
+
+    def update(self, state):
+        """Moves the camera, then changes which chunks are active to match. Called
+        by State.advance at the end of each frame."""
+        self.follow(state)
+
+        # walls one chunk beyond the active ones, so that nothing can step
+        # into a wall that isn't there yet
+        for key in self.chunk_range(self.active_margin + 1):
+            if key not in self.solid_loaded:
+                self.load_solid(state, key)
+
+        active = self.chunk_range(self.active_margin)
+        for key in sorted(active - self.active):
+            self.activate(state, key)
+        if active != self.active:
+            candidates = state.objects
+        else:
+            # only objects that advanced can have wandered out
+            candidates = state.awake
+        self.active = active
+
+        # park objects that are outside the active chunks, whether their chunk
+        # just became inactive or they wandered out of the active area
+        parked = []
+        for obj in candidates:
+            if isinstance(obj, gamelogic.Moveable):
+                key = self.chunk_at(obj.x + obj.width / 2, obj.y + obj.height / 2)
+                if key not in active:
+                    self.chunk(key).objects.append(obj)
+                    parked.append(obj)
+        state.remove_objects(parked)
+
+        keep = self.chunk_range(self.keep_margin)
+        for key in self.chunks.keys():
+            if key not in keep:
+                if self.chunks[key].objects:
+                    # its objects wait here for the camera to come back
+                    self.chunks[key].tiles = None
+                else:
+                    del self.chunks[key]
+
+    def tiles(self, left, top, right, bottom):
+        """Yields (tx, ty, gid) for each non-empty tile from tile (left, top) to
+        (right, bottom) inclusive, with each layer's tiles after the tiles of
+        the layers under it in the same chunk"""
+        left = max(left, 0)
+        top = max(top, 0)
+        right = min(right, self.tilemap.width - 1)
+        bottom = min(bottom, self.tilemap.height - 1)
+        for cy in range(top // self.chunk_ytiles, bottom // self.chunk_ytiles + 1):
+            for cx in range(left // self.chunk_xtiles, right // self.chunk_xtiles + 1):
+                chunk = self.chunk((cx, cy))
+                self.load(chunk)
+                x0 = max(left, chunk.tx)
+                x1 = min(right, chunk.tx + chunk.xtiles - 1)
+                y0 = max(top, chunk.ty)
+                y1 = min(bottom, chunk.ty + chunk.ytiles - 1)
+                for tiles in chunk.tiles:
+                    for ty in range(y0, y1 + 1):
+                        row = (ty - chunk.ty) * chunk.xtiles - chunk.tx
+                        for tx in range(x0, x1 + 1):
+                            gid = tiles[row + tx]
+                            if gid:
+                                yield tx, ty, gid
+
+    def snapshot(self):
+        "Returns what restore() needs to put the chunks back as they are now"
+        chunks = {}
+        for key, chunk in self.chunks.iteritems():
+            if chunk.objects:
+                chunks[key] = (tuple(chunk.objects),
+                               tuple(gamelogic.get_attributes(obj) for obj in chunk.objects))
+        return (self.camera, frozenset(self.active), frozenset(self.spawned), chunks)
+
+    def restore(self, state, snapshot):
+        "Called by State.restore with the result of snapshot()"
+        self.camera, active, spawned, chunks = snapshot
+        self.active = set(active)
+        self.spawned = set(spawned)
+        self.chunks = {}
+        for key, (objects, attributes) in chunks.iteritems():
+            chunk = self.chunk(key)
+            chunk.objects = list(objects)
+            for obj, attrs in zip(objects, attributes):
+                gamelogic.set_attributes(obj, attrs)
+
+        for key in self.chunk_range(self.active_margin + 1):
+            if key not in self.solid_loaded:
+                self.load_solid(state, key)